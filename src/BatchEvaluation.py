@@ -0,0 +1,240 @@
+"""
+Batch evaluation for offline analysis: positions are packed into an (N, 64)
+int8 array of piece codes and scored with one NumPy gather against the material
++ piece square tables plus array operations for the pawn structure, giving
+exactly the numbers of Searcher.evaluation.
+NumPy is only needed by this module and the tools built on it, not by the game.
+
+    python src/BatchEvaluation.py --positions 20000
+"""
+import argparse
+import json
+import random
+import time
+import numpy as np
+import ChessEngine as ChessEngine
+import Searcher as Searcher
+
+# piece code of every square content, 0 is an empty square
+PIECES = ('--', 'wp', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bp', 'bN', 'bB', 'bR', 'bQ', 'bK')
+PIECE_CODES = {piece: code for code, piece in enumerate(PIECES)}
+# FEN board characters, '.' standing for an empty square, translated to piece codes
+FEN_TRANSLATION = bytes.maketrans(
+    ('.' + ''.join(piece[1].upper() if piece[0] == 'w' else piece[1].lower() for piece in PIECES[1:])).encode(),
+    bytes(range(len(PIECES))))
+EMPTY_RUNS = [(str(run), '.' * run) for run in range(8, 0, -1)]
+# positions scored per gather, small enough that the temporary (CHUNK, 64) arrays stay in cache
+CHUNK = 1 << 12
+
+def square_value_table():
+    """
+    (13, 64) table of the score every piece code adds on every square, positive
+    for white. Read from ChessEngine.SQUARE_VALUES so it follows tuned tables.
+    Every value fits in int16, which keeps the gather small.
+    """
+    table = np.zeros((len(PIECES), ChessEngine.ROWS * ChessEngine.COLS), dtype=np.int16)
+    for code, piece in enumerate(PIECES[1:], 1):
+        values = ChessEngine.SQUARE_VALUES[piece]
+        table[code] = values if piece[0] == 'w' else [-value for value in values]
+    return table
+
+def pack_states(states):
+    """
+    (N, 64) int8 piece codes of game states, squares numbered row * 8 + col
+    """
+    packed = bytearray()
+    for gs in states:
+        packed += bytes(PIECE_CODES[square] for row in gs.board for square in row)
+    return np.frombuffer(bytes(packed), dtype=np.int8).reshape(-1, 64)
+
+def pack_fens(fens):
+    """
+    (N, 64) int8 piece codes read straight from the board field of FEN strings,
+    without building game states
+    """
+    boards = []
+    for fen in fens:
+        board = fen.split(' ', 1)[0].replace('/', '')
+        for digits, empty in EMPTY_RUNS:
+            board = board.replace(digits, empty)
+        boards.append(board)
+    packed = ''.join(boards).encode('ascii').translate(FEN_TRANSLATION)
+    return np.frombuffer(packed, dtype=np.int8).reshape(-1, 64)
+
+def square_indices(boards):
+    """
+    Index of (square, piece code) of every square of the packed positions in
+    the tables laid out square by square. Small enough for int16 so the gathers
+    never widen the boards to int64.
+    """
+    offsets = (np.arange(ChessEngine.ROWS * ChessEngine.COLS) * len(PIECES)).astype(np.int16)
+    return np.asarray(boards, dtype=np.int8) + offsets
+
+def evaluate_boards(boards, table=None):
+    """
+    Material + piece square + pawn structure score, white minus black, of every
+    packed position
+    """
+    if table is None:
+        table = square_value_table()
+    boards = np.asarray(boards, dtype=np.int8)
+    values = table.T.ravel()
+    pawn_bits = pawn_bit_table().T.ravel()
+    file_scores = pawn_file_table()
+    scores = np.empty(len(boards), dtype=np.int32)
+    for start in range(0, len(boards), CHUNK):
+        indices = square_indices(boards[start:start + CHUNK])
+        scores[start:start + CHUNK] = np.take(values, indices).sum(axis=1, dtype=np.int32) + \
+            pawn_structure_of_files(pawn_files(indices, pawn_bits), file_scores)
+    return scores
+
+def pawn_bit_table():
+    """
+    (13, 64) table of the bit of its row a pawn sets in the mask of its file: the
+    low byte for white pawns, the high byte for black pawns
+    """
+    bits = np.zeros((len(PIECES), ChessEngine.ROWS, ChessEngine.COLS), dtype=np.uint16)
+    rows = np.arange(ChessEngine.ROWS, dtype=np.uint16)[:, None]
+    bits[PIECE_CODES['wp']] = 1 << rows
+    bits[PIECE_CODES['bp']] = 1 << (rows + 8)
+    return bits.reshape(len(PIECES), -1)
+
+def pawn_files(indices, pawn_bits):
+    """
+    (N, 8) uint16 row masks of the pawns on every file, one gather of the row bits
+    of the squares. A row of eight uint16 masks is two uint64 words, so ORing the
+    rows of words together builds the masks of all files at once, folding the rows
+    in halves which is faster than a reduce along the strided axis.
+    """
+    bits = np.take(pawn_bits, indices)
+    words = bits.view(np.uint64).reshape(len(bits), ChessEngine.ROWS, -1)
+    while words.shape[1] > 1:
+        half = words.shape[1] // 2
+        words = words[:, :half] | words[:, half:]
+    return words[:, 0].view(np.uint16)
+
+def pawn_file_table():
+    """
+    Pawn structure score of the pawns of one side on one file, signed white minus
+    black, indexed by side << 17 | own pawn rows << 9 | rival pawn rows on the file
+    and its neighbours << 1 | no own pawns on the neighbouring files. The rows are
+    masks of 8 bits. Built from the Searcher constants on every call so changes to
+    them are followed.
+    """
+    masks = np.arange(256)
+    rows = np.arange(ChessEngine.ROWS)
+    bits = (masks[:, None] >> rows) & 1
+    counts = bits.sum(axis=1)
+    bonus = np.array(Searcher.PASSED_PAWN_BONUS)
+    row_bits = 1 << rows
+    table = np.empty((2, 256, 256, 2), dtype=np.int16)
+    # rival pawns on the row or in front: rows above for white, below for black
+    for side, sign, advanced, blocked in (
+            (0, 1, ChessEngine.ROWS - 1 - rows, np.logical_or.accumulate(bits, axis=1)),
+            (1, -1, rows, np.logical_or.accumulate(bits[:, ::-1], axis=1)[:, ::-1])):
+        passed = bits @ bonus[advanced]
+        front = ~blocked @ row_bits
+        doubled = Searcher.DOUBLED_PAWN_PENALTY * np.maximum(counts - 1, 0)
+        isolated = Searcher.ISOLATED_PAWN_PENALTY * counts
+        score = passed[masks[:, None] & front[None, :]] - doubled[:, None]
+        table[side, :, :, 0] = sign * score
+        table[side, :, :, 1] = sign * (score - isolated[:, None])
+    return table.ravel()
+
+def pawn_structure_of_files(files, file_scores):
+    """
+    Pawn structure score of every position from the row masks of its files
+    """
+    files = files.astype(np.uint32)
+    neighbours = np.zeros_like(files)
+    neighbours[:, 1:] |= files[:, :-1]
+    neighbours[:, :-1] |= files[:, 1:]
+    span = files | neighbours
+    white = ((files & 0xFF) << 9) | ((span >> 8) << 1) | ((neighbours & 0xFF) == 0)
+    black = (1 << 17) | ((files >> 8) << 9) | ((span & 0xFF) << 1) | ((neighbours >> 8) == 0)
+    return np.take(file_scores, white).sum(axis=1, dtype=np.int32) + \
+        np.take(file_scores, black).sum(axis=1, dtype=np.int32)
+
+def pawn_structure(boards):
+    """
+    Searcher.pawn_structure of every packed position
+    """
+    return pawn_structure_of_files(pawn_files(square_indices(boards), pawn_bit_table().T.ravel()),
+                                   pawn_file_table())
+
+def evaluate_states(states):
+    """
+    Searcher.evaluation of every game state, including the scores of states
+    already found to be checkmate or stalemate
+    """
+    states = list(states)
+    scores = evaluate_boards(pack_states(states))
+    for i, gs in enumerate(states):
+        if gs.checkmate:
+            scores[i] = -Searcher.CHECKMATE if gs.white_to_move else Searcher.CHECKMATE
+        elif gs.stalemate:
+            scores[i] = Searcher.STALEMATE
+    return scores
+
+def random_fens(count, max_plies=80, seed=0):
+    """
+    Positions from random games, for testing and benchmarking
+    """
+    rng = random.Random(seed)
+    fens = []
+    while len(fens) < count:
+        gs = ChessEngine.GameState()
+        for ply in range(rng.randrange(1, max_plies)):
+            valid_moves = gs.get_valid_moves()
+            if valid_moves == []:
+                break
+            gs.make_move(rng.choice(valid_moves))
+            fens.append(gs.get_fen())
+    return fens[:count]
+
+def best_time(function, repeat):
+    """
+    Result of the function and the shortest of repeat timed calls, in seconds
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds.append(time.perf_counter() - start)
+    return result, min(seconds)
+
+def benchmark(count=20000, repeat=3):
+    """
+    Positions per second of the batch evaluation and of the scalar ones, which must
+    all agree, each the best of repeat runs. Searcher.evaluation reads the score
+    kept up to date by the game state, so for positions that were not played into,
+    the scalar cost is Searcher.evaluate_board scanning the board from scratch.
+    """
+    fens = random_fens(count)
+    states = []
+    for fen in fens:
+        gs = ChessEngine.GameState()
+        gs.load_fen(fen)
+        states.append(gs)
+
+    scalar, scalar_seconds = best_time(lambda: [Searcher.evaluate_board(gs) for gs in states], repeat)
+    incremental = [Searcher.evaluation(gs) for gs in states]
+    boards, pack_seconds = best_time(lambda: pack_fens(fens), repeat)
+    batch, batch_seconds = best_time(lambda: evaluate_boards(boards), repeat)
+
+    mismatches = int(np.count_nonzero((batch != np.array(scalar)) | (batch != np.array(incremental))))
+    return {
+        'positions': count,
+        'mismatches': mismatches,
+        'scalar_per_second': int(count / scalar_seconds),
+        'batch_per_second': int(count / batch_seconds),
+        'pack_per_second': int(count / pack_seconds),
+        'speedup': round(scalar_seconds / batch_seconds, 1),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare scalar and NumPy batch evaluation')
+    parser.add_argument('--positions', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3, help='runs timed, the best one counts')
+    args = parser.parse_args()
+    print(json.dumps(benchmark(args.positions, args.repeat), indent=2))
@@ -0,0 +1,408 @@
+from ChessEngine import GameState, Move, ROWS, COLS, PROMOTION_PIECES, SEE_ORDER, \
+    WHITE_KING_SIDE, WHITE_QUEEN_SIDE, BLACK_KING_SIDE, BLACK_QUEEN_SIDE
+
+# Squares are numbered row * 8 + col, so square 0 is a8 and square 63 is h1,
+# matching the indexing of GameState.board. Bit n of a bitboard is square n.
+FULL = (1 << 64) - 1
+SQUARES = [(sq // COLS, sq % COLS) for sq in range(ROWS * COLS)]
+PIECES = [color + piece for color in 'wb' for piece in 'pNBRQK']
+
+ROOK_DIRECTIONS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+BISHOP_DIRECTIONS = ((-1, 1), (-1, -1), (1, -1), (1, 1))
+
+def _in_range(row, col):
+    return 0 <= row < ROWS and 0 <= col < COLS
+
+def _bit(row, col):
+    return 1 << (row * COLS + col)
+
+def _step_attacks(offsets):
+    """
+    Attack table of a piece that moves a single step by one of the offsets
+    """
+    table = []
+    for row, col in SQUARES:
+        attacks = 0
+        for d_row, d_col in offsets:
+            if _in_range(row + d_row, col + d_col):
+                attacks |= _bit(row + d_row, col + d_col)
+        table.append(attacks)
+    return table
+
+KNIGHT_ATTACKS = _step_attacks(((-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)))
+KING_ATTACKS = _step_attacks(ROOK_DIRECTIONS + BISHOP_DIRECTIONS)
+# squares attacked by a pawn of the given color standing on a square
+PAWN_ATTACKS = {'w': _step_attacks(((-1, -1), (-1, 1))), 'b': _step_attacks(((1, -1), (1, 1)))}
+
+def _slide(sq, directions, occupied):
+    """
+    Squares reached by sliding from sq until the first occupied square (included)
+    """
+    row, col = SQUARES[sq]
+    attacks = 0
+    for d_row, d_col in directions:
+        r, c = row + d_row, col + d_col
+        while _in_range(r, c):
+            attacks |= _bit(r, c)
+            if occupied & _bit(r, c):
+                break
+            r += d_row
+            c += d_col
+    return attacks
+
+def _relevant_mask(sq, directions):
+    """
+    Squares whose occupancy changes the attacks from sq, the board edge never does
+    """
+    row, col = SQUARES[sq]
+    mask = 0
+    for d_row, d_col in directions:
+        r, c = row + d_row, col + d_col
+        while _in_range(r + d_row, c + d_col):
+            mask |= _bit(r, c)
+            r += d_row
+            c += d_col
+    return mask
+
+def _sliding_tables(directions):
+    """
+    For every square the relevant occupancy mask and a table mapping every
+    relevant occupancy to the attacked squares
+    """
+    masks = []
+    tables = []
+    for sq in range(ROWS * COLS):
+        mask = _relevant_mask(sq, directions)
+        table = {}
+        subset = 0
+        while True:
+            table[subset] = _slide(sq, directions, subset)
+            subset = (subset - mask) & mask
+            if subset == 0:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+ROOK_MASKS, ROOK_TABLES = _sliding_tables(ROOK_DIRECTIONS)
+BISHOP_MASKS, BISHOP_TABLES = _sliding_tables(BISHOP_DIRECTIONS)
+ROOK_RAYS = [_slide(sq, ROOK_DIRECTIONS, 0) for sq in range(ROWS * COLS)]
+BISHOP_RAYS = [_slide(sq, BISHOP_DIRECTIONS, 0) for sq in range(ROWS * COLS)]
+
+def rook_attacks(sq, occupied):
+    return ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+
+def bishop_attacks(sq, occupied):
+    return BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+
+def _between():
+    """
+    BETWEEN[a][b] holds the squares strictly between a and b when they share a line
+    """
+    table = [[0] * (ROWS * COLS) for _ in range(ROWS * COLS)]
+    for sq in range(ROWS * COLS):
+        row, col = SQUARES[sq]
+        for d_row, d_col in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            squares = 0
+            r, c = row + d_row, col + d_col
+            while _in_range(r, c):
+                table[sq][r * COLS + c] = squares
+                squares |= _bit(r, c)
+                r += d_row
+                c += d_col
+    return table
+
+BETWEEN = _between()
+PROMOTION_RANKS = 0xFF | 0xFF << 56
+
+class BitboardGameState(GameState):
+    """
+    GameState that keeps a bitboard for every piece and generates legal moves
+    with attack tables instead of scanning the 8x8 board.
+    The board list is still maintained so the rest of the engine works unchanged.
+    """
+    def __init__(self):
+        super().__init__()
+        self.init_bitboards()
+
+    def init_bitboards(self):
+        """
+        Builds the bitboards from the board
+        """
+        self.bitboards = {piece: 0 for piece in PIECES}
+        self.occupancy = {'w': 0, 'b': 0}
+        for sq, (row, col) in enumerate(SQUARES):
+            piece = self.board[row][col]
+            if piece != '--':
+                self.bitboards[piece] |= 1 << sq
+                self.occupancy[piece[0]] |= 1 << sq
+        # bitboards after every move of the move log up to the last one that needed them,
+        # most positions of a search or perft are left without generating any moves
+        self.bitboard_log = [(self.bitboards, self.occupancy)]
+
+    def load_fen(self, fen):
+        super().load_fen(fen)
+        self.init_bitboards()
+
+    def undo_move(self):
+        super().undo_move()
+        if len(self.bitboard_log) > len(self.move_log) + 1:
+            self.bitboard_log.pop()
+
+    def sync_bitboards(self):
+        """
+        Brings the bitboards up to the current position by playing the moves made since
+        they were last needed. Called by every method that reads them from outside.
+        """
+        log = self.bitboard_log
+        while len(log) <= len(self.move_log):
+            move = self.move_log[len(log) - 1]
+            bb, occupancy = log[-1]
+            bb = bb.copy()
+            occupancy = occupancy.copy()
+            piece = move.piece_moved
+            color = piece[0]
+            start = 1 << (move.initial_pos_x * COLS + move.initial_pos_y)
+            end = 1 << (move.final_pos_x * COLS + move.final_pos_y)
+            occupancy[color] ^= start | end
+            if move.is_pawn_promotion:
+                bb[piece] ^= start
+                bb[color + move.promotion_piece] ^= end
+            else:
+                bb[piece] ^= start | end
+            captured = move.piece_captured
+            if captured != '--':
+                if move.is_en_passant_move:
+                    end = 1 << (move.initial_pos_x * COLS + move.final_pos_y)
+                bb[captured] ^= end
+                occupancy[captured[0]] ^= end
+            elif move.is_castle_move:
+                if move.final_pos_y - move.initial_pos_y == 2:
+                    rook = (end << 1) | (end >> 1)
+                else:
+                    rook = (end >> 2) | (end << 1)
+                bb[color + 'R'] ^= rook
+                occupancy[color] ^= rook
+            log.append((bb, occupancy))
+        self.bitboards, self.occupancy = log[len(self.move_log)]
+
+    def has_non_pawn_material(self):
+        self.sync_bitboards()
+        color = 'w' if self.white_to_move else 'b'
+        bb = self.bitboards
+        return (bb[color + 'N'] | bb[color + 'B'] | bb[color + 'R'] | bb[color + 'Q']) != 0
+
+    def attackers(self, sq, color, occupied):
+        """
+        Bitboard of the pieces of color attacking sq, given the occupied squares.
+        The bitboards must be synced.
+        """
+        bb = self.bitboards
+        queens = bb[color + 'Q']
+        return (KNIGHT_ATTACKS[sq] & bb[color + 'N']) | \
+            (KING_ATTACKS[sq] & bb[color + 'K']) | \
+            (PAWN_ATTACKS['b' if color == 'w' else 'w'][sq] & bb[color + 'p']) | \
+            (rook_attacks(sq, occupied) & (bb[color + 'R'] | queens)) | \
+            (bishop_attacks(sq, occupied) & (bb[color + 'B'] | queens))
+
+    def exchange_attackers(self, move):
+        """
+        GameState.exchange_attackers with attack tables: capturing pieces are
+        taken out of the occupancy, so the slider attacks see through them
+        """
+        self.sync_bitboards()
+        sq = move.final_pos_x * COLS + move.final_pos_y
+        bb = self.bitboards
+        occupied = (self.occupancy['w'] | self.occupancy['b']) ^ (1 << (move.initial_pos_x * COLS + move.initial_pos_y))
+        if move.is_en_passant_move:
+            occupied ^= 1 << (move.initial_pos_x * COLS + move.final_pos_y)
+        color = 'b' if move.piece_moved[0] == 'w' else 'w'
+        while True:
+            attackers = self.attackers(sq, color, occupied) & occupied
+            if attackers == 0:
+                return
+            for piece_type in SEE_ORDER:
+                found = attackers & bb[color + piece_type]
+                if found:
+                    break
+            occupied ^= found & -found
+            yield piece_type
+            color = 'b' if color == 'w' else 'w'
+
+    def generate_moves(self, captures, quiets):
+        """
+        Legal moves of the kinds asked for: captures (with promotions) and quiet moves
+        """
+        self.sync_bitboards()
+        color = 'w' if self.white_to_move else 'b'
+        rival = 'b' if self.white_to_move else 'w'
+        bb = self.bitboards
+        board = self.board
+        own = self.occupancy[color]
+        enemy = self.occupancy[rival]
+        occupied = own | enemy
+        king = bb[color + 'K']
+        king_sq = king.bit_length() - 1
+        checkers = self.attackers(king_sq, rival, occupied)
+        self.in_check = checkers != 0
+        moves = []
+        # squares the moves of the asked kinds may end on
+        kind_mask = (enemy if captures else 0) | (~occupied & FULL if quiets else 0)
+
+        # king moves, the king itself must not block attacks on the squares behind it
+        without_king = occupied ^ king
+        targets = KING_ATTACKS[king_sq] & kind_mask
+        while targets:
+            target = targets & -targets
+            targets ^= target
+            target_sq = target.bit_length() - 1
+            if not self.attackers(target_sq, rival, without_king):
+                moves.append(Move(SQUARES[king_sq], SQUARES[target_sq], board))
+
+        if checkers & (checkers - 1) == 0:
+            # zero or one checker, other pieces may move onto the target squares
+            if checkers:
+                checker_sq = checkers.bit_length() - 1
+                target_mask = BETWEEN[king_sq][checker_sq] | checkers
+            else:
+                target_mask = FULL
+
+            # pinned pieces may only move along the line between king and pinner
+            pins = {}
+            snipers = (ROOK_RAYS[king_sq] & (bb[rival + 'R'] | bb[rival + 'Q'])) | \
+                (BISHOP_RAYS[king_sq] & (bb[rival + 'B'] | bb[rival + 'Q']))
+            while snipers:
+                sniper = snipers & -snipers
+                snipers ^= sniper
+                sniper_sq = sniper.bit_length() - 1
+                blockers = BETWEEN[king_sq][sniper_sq] & occupied
+                if blockers and blockers & (blockers - 1) == 0 and blockers & own:
+                    pins[blockers] = BETWEEN[king_sq][sniper_sq] | sniper
+
+            self.pawn_moves_bb(color, rival, king_sq, own, enemy, target_mask, pins, moves, captures, quiets)
+
+            pieces = bb[color + 'N']
+            while pieces:
+                piece = pieces & -pieces
+                pieces ^= piece
+                if piece in pins:
+                    continue    # a pinned knight can never move
+                sq = piece.bit_length() - 1
+                self.add_moves(sq, KNIGHT_ATTACKS[sq] & kind_mask & target_mask, moves)
+
+            for piece_type, attacks in (('B', bishop_attacks), ('R', rook_attacks), ('Q', None)):
+                pieces = bb[color + piece_type]
+                while pieces:
+                    piece = pieces & -pieces
+                    pieces ^= piece
+                    sq = piece.bit_length() - 1
+                    if attacks is None:
+                        targets = rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)
+                    else:
+                        targets = attacks(sq, occupied)
+                    targets &= kind_mask & target_mask
+                    if piece in pins:
+                        targets &= pins[piece]
+                    self.add_moves(sq, targets, moves)
+
+            if not checkers and quiets:
+                self.castle_moves_bb(color, rival, king_sq, occupied, moves)
+        return moves
+
+    def add_moves(self, sq, targets, moves):
+        """
+        Appends a move from sq to every square in targets
+        """
+        start = SQUARES[sq]
+        board = self.board
+        while targets:
+            target = targets & -targets
+            targets ^= target
+            moves.append(Move(start, SQUARES[target.bit_length() - 1], board))
+
+    def pawn_moves_bb(self, color, rival, king_sq, own, enemy, target_mask, pins, moves,
+                      captures=True, quiets=True):
+        """
+        Legal pawn pushes, captures and en passant captures. Pushes to the last
+        rank are promotions and count as captures.
+        """
+        board = self.board
+        empty = ~(own | enemy) & FULL
+        if color == 'w':
+            step = -8
+            start_row = 6
+        else:
+            step = 8
+            start_row = 1
+        pawns = self.bitboards[color + 'p']
+        while pawns:
+            pawn = pawns & -pawns
+            pawns ^= pawn
+            sq = pawn.bit_length() - 1
+            allowed = target_mask
+            if pawn in pins:
+                allowed &= pins[pawn]
+            targets = 0
+            one = sq + step
+            if empty >> one & 1:
+                targets |= 1 << one
+                two = one + step
+                if SQUARES[sq][0] == start_row and empty >> two & 1:
+                    targets |= 1 << two
+            if not quiets:
+                targets &= PROMOTION_RANKS
+            if not captures:
+                targets &= ~PROMOTION_RANKS
+            else:
+                targets |= PAWN_ATTACKS[color][sq] & enemy
+            targets &= allowed
+            if targets & PROMOTION_RANKS:
+                while targets:
+                    target = targets & -targets
+                    targets ^= target
+                    for promotion_piece in PROMOTION_PIECES:
+                        moves.append(Move(SQUARES[sq], SQUARES[target.bit_length() - 1], board,
+                                          promotion_piece = promotion_piece))
+            else:
+                self.add_moves(sq, targets, moves)
+
+        if self.en_passant_square != () and captures:
+            ep_row, ep_col = self.en_passant_square
+            ep_sq = ep_row * COLS + ep_col
+            captured_sq = ep_sq - step
+            # pawns of our color that attack the en passant square
+            pawns = PAWN_ATTACKS[rival][ep_sq] & self.bitboards[color + 'p']
+            while pawns:
+                pawn = pawns & -pawns
+                pawns ^= pawn
+                # test the king on the board after the capture, this covers pins
+                # along the rank of both pawns as well
+                occupied = ((own | enemy) ^ pawn ^ (1 << captured_sq)) | (1 << ep_sq)
+                bb = self.bitboards
+                queens = bb[rival + 'Q']
+                if (KNIGHT_ATTACKS[king_sq] & bb[rival + 'N']) or \
+                    (PAWN_ATTACKS[color][king_sq] & bb[rival + 'p'] & ~(1 << captured_sq)) or \
+                    (rook_attacks(king_sq, occupied) & (bb[rival + 'R'] | queens)) or \
+                    (bishop_attacks(king_sq, occupied) & (bb[rival + 'B'] | queens)):
+                    continue
+                moves.append(Move(SQUARES[pawn.bit_length() - 1], (ep_row, ep_col), board,
+                                  is_en_passant_move = True))
+
+    def castle_moves_bb(self, color, rival, king_sq, occupied, moves):
+        """
+        Castling moves, the king may not pass through or land on an attacked square
+        """
+        if color == 'w':
+            king_side = self.castling_rights & WHITE_KING_SIDE
+            queen_side = self.castling_rights & WHITE_QUEEN_SIDE
+        else:
+            king_side = self.castling_rights & BLACK_KING_SIDE
+            queen_side = self.castling_rights & BLACK_QUEEN_SIDE
+        if king_side and not occupied & (0b11 << (king_sq + 1)):
+            if not self.attackers(king_sq + 1, rival, occupied) and \
+                not self.attackers(king_sq + 2, rival, occupied):
+                moves.append(Move(SQUARES[king_sq], SQUARES[king_sq + 2], self.board, is_castle_move = True))
+        if queen_side and not occupied & (0b111 << (king_sq - 3)):
+            if not self.attackers(king_sq - 1, rival, occupied) and \
+                not self.attackers(king_sq - 2, rival, occupied):
+                moves.append(Move(SQUARES[king_sq], SQUARES[king_sq - 2], self.board, is_castle_move = True))
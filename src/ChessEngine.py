@@ -1,4 +1,61 @@
+import random
+import time
+
 ROWS = COLS = 8
+FILES = 'abcdefgh'
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+# queen first, so a move entered without a choice of piece is a queen promotion
+PROMOTION_PIECES = ('Q', 'R', 'B', 'N')
+PROMOTION_INDEX = {piece: index for index, piece in enumerate(PROMOTION_PIECES)}
+KNIGHT_OFFSETS = ((-2, -1), (-2, 1), (-1, -2), (-1, 2), (2, -1), (2, 1), (1, -2), (1, 2))
+KING_OFFSETS = ((-1, 0), (1, 0), (0, -1), (0, 1), (-1, 1), (-1, -1), (1, -1), (1, 1))
+SLIDER_DIRECTIONS = {'R': KING_OFFSETS[:4], 'B': KING_OFFSETS[4:], 'Q': KING_OFFSETS}
+
+# castling rights are the bits of a mask, which also indexes the zobrist castling keys
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+ALL_CASTLING = 15
+# FEN letter of every castling right, with the row and column of the rook it needs
+CASTLING_RIGHTS = (('K', WHITE_KING_SIDE, 7, 7), ('Q', WHITE_QUEEN_SIDE, 7, 0),
+                   ('k', BLACK_KING_SIDE, 0, 7), ('q', BLACK_QUEEN_SIDE, 0, 0))
+# castling rights kept by a move from or to every square: moving a king or a rook
+# off its starting square, or capturing a rook on it, loses the rights that need it
+CASTLING_KEPT = [ALL_CASTLING] * (ROWS * COLS)
+CASTLING_KEPT[7 * COLS + 4] = ALL_CASTLING & ~(WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+CASTLING_KEPT[0 * COLS + 4] = ALL_CASTLING & ~(BLACK_KING_SIDE | BLACK_QUEEN_SIDE)
+for _letter, _right, _row, _col in CASTLING_RIGHTS:
+    CASTLING_KEPT[_row * COLS + _col] = ALL_CASTLING & ~_right
+
+# Zobrist keys: a random 64-bit number for every piece on every square, for every
+# combination of castling rights, for every en passant file and for black to move
+_zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = {color + piece: [_zobrist_random.getrandbits(64) for _ in range(ROWS * COLS)]
+                  for color in 'wb' for piece in 'pNBRQK'}
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(16)]
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for _ in range(COLS)]
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+
+# material + piece square value of every piece on every square, counted for the
+# side owning the piece. Filled in by the evaluation through set_square_values.
+SQUARE_VALUES = {piece: [0] * (ROWS * COLS) for piece in ZOBRIST_PIECES}
+
+# piece values of the static exchange evaluation, the king is worth more than
+# anything it could win so it only recaptures last
+SEE_VALUES = {'p': 100, 'N': 320, 'B': 330, 'R': 500, 'Q': 900, 'K': 20000}
+# the order in which the static exchange evaluation brings in attackers
+SEE_ORDER = 'pNBRQK'
+
+def set_square_values(pst):
+    """
+    Takes piece square tables from white's point of view, indexed by piece type,
+    and mirrors them for black. Game states created earlier need compute_scores().
+    """
+    for piece_type, table in pst.items():
+        SQUARE_VALUES['w' + piece_type][:] = table
+        SQUARE_VALUES['b' + piece_type][:] = [table[(ROWS - 1 - sq // COLS) * COLS + sq % COLS]
+                                              for sq in range(ROWS * COLS)]
 
 class GameState():
     def __init__(self):
@@ -26,18 +83,119 @@ class GameState():
         self.black_king_location = (0, 4)
         self.in_check = False
         self.pins = []
+        # kinds of moves generate_moves is producing, read by the piece generators
+        self.generate_captures = True
+        self.generate_quiets = True
+        # squares attacked by the side not to move and the position they belong to
+        self.attack_map = None
+        self.attack_map_key = None
         self.checks = []
         self.checkmate = False
         self.stalemate = False
-        self.three_move_draw = False
         self.en_passant_square = ()
-        self.castling = self.Castling(True, True, True, True)
-        self.castle_log = [(True, True, True, True)]
+        self.castling_rights = ALL_CASTLING
+        self.zobrist_key = self.compute_zobrist_key()
+        # zobrist key of the pawns alone, for the pawn structure cache
+        self.pawn_key = self.compute_pawn_key()
+        # half moves since the last capture or pawn move, for the fifty move rule
+        self.halfmove_clock = 0
+        self.compute_scores()
+        # one record for every move and null move made, the state they cannot be undone from:
+        # (zobrist key, castling rights, en passant square, halfmove clock, pawn key,
+        # white score, black score). The keys also give the positions for repetitions.
+        self.undo_log = []
+        # half moves played before the first position, for the FEN move counter
+        self.initial_ply = 0
+
+    def load_fen(self, fen):
+        """
+        Sets up the position described by a FEN string
+        """
+        fields = fen.split()
+        self.board = []
+        for rank in fields[0].split('/'):
+            row = []
+            for char in rank:
+                if char.isdigit():
+                    row += ['--'] * int(char)
+                else:
+                    row.append(('w' if char.isupper() else 'b') + (char.upper() if char.lower() != 'p' else 'p'))
+            self.board.append(row)
+        for row in range(ROWS):
+            for col in range(COLS):
+                if self.board[row][col] == 'wK':
+                    self.white_king_location = (row, col)
+                elif self.board[row][col] == 'bK':
+                    self.black_king_location = (row, col)
+        self.white_to_move = fields[1] == 'w'
+        castling = fields[2] if len(fields) > 2 else '-'
+        # a right is only kept when its king and rook are on their starting squares
+        self.castling_rights = 0
+        for letter, right, row, col in CASTLING_RIGHTS:
+            color = 'w' if row == 7 else 'b'
+            if letter in castling and self.board[row][4] == color + 'K' and self.board[row][col] == color + 'R':
+                self.castling_rights |= right
+        en_passant = fields[3] if len(fields) > 3 else '-'
+        self.en_passant_square = parse_square(en_passant) if en_passant != '-' else ()
+        self.move_log = []
+        self.undo_log = []
+        self.in_check = False
+        self.pins = []
+        self.checks = []
+        self.checkmate = False
+        self.stalemate = False
+        self.zobrist_key = self.compute_zobrist_key()
+        self.pawn_key = self.compute_pawn_key()
+        self.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+        self.compute_scores()
+        fullmove = int(fields[5]) if len(fields) > 5 else 1
+        self.initial_ply = (fullmove - 1) * 2 + (0 if self.white_to_move else 1)
+
+    def get_fen(self):
+        """
+        FEN string of the current position
+        """
+        ranks = []
+        for row in self.board:
+            rank = ''
+            empty = 0
+            for square in row:
+                if square == '--':
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += square[1].upper() if square[0] == 'w' else square[1].lower()
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+        castling = ''.join(letter for letter, right, row, col in CASTLING_RIGHTS if self.castling_rights & right)
+        en_passant = square_name(*self.en_passant_square) if self.en_passant_square != () else '-'
+        return ' '.join(('/'.join(ranks), 'w' if self.white_to_move else 'b', castling or '-', en_passant,
+                         str(self.halfmove_clock), str((self.initial_ply + len(self.move_log)) // 2 + 1)))
+
+    def parse_move(self, notation):
+        """
+        The legal move with the given long algebraic notation, None if there is none
+        """
+        for move in self.get_valid_moves():
+            if move.get_notation() == notation:
+                return move
+        return None
 
     def make_move(self, move):
         """
         Takes a move and executes it
         """
+        old_castling_rights = self.castling_rights
+        old_en_passant_square = self.en_passant_square
+        self.undo_log.append((self.zobrist_key, old_castling_rights, old_en_passant_square, self.halfmove_clock,
+                              self.pawn_key, self.white_score, self.black_score))
+        if move.piece_moved[1] == 'p' or move.is_capture:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
         self.board[move.initial_pos_x][move.initial_pos_y] = '--'
         self.board[move.final_pos_x][move.final_pos_y] = move.piece_moved
         self.move_log.append(move)
@@ -50,7 +208,7 @@ class GameState():
 
         # Pawn promotion
         if move.is_pawn_promotion:
-            self.board[move.final_pos_x][move.final_pos_y] = move.piece_moved[0] + 'Q'
+            self.board[move.final_pos_x][move.final_pos_y] = move.piece_moved[0] + move.promotion_piece
         # en passant
         if move.is_en_passant_move:
             self.board[move.initial_pos_x][move.final_pos_y] = '--'
@@ -70,14 +228,154 @@ class GameState():
                 self.board[move.final_pos_x][move.final_pos_y+1] = self.board[move.final_pos_x][move.final_pos_y-2]
                 self.board[move.final_pos_x][move.final_pos_y-2] = '--'
         # updating castling rights
-        self.update_castling_rights(move)
-        self.castle_log.append((self.castling.wks, self.castling.wqs, self.castling.bks, self.castling.bqs))
+        self.castling_rights &= CASTLING_KEPT[move.initial_pos_x * COLS + move.initial_pos_y] & \
+            CASTLING_KEPT[move.final_pos_x * COLS + move.final_pos_y]
+        self.update_zobrist_key(move, old_castling_rights, old_en_passant_square)
+        self.update_scores(move)
 
-        self.check_three_move_draw()
+    def make_null_move(self):
+        """
+        Passes the turn to the opponent without moving a piece, for null move pruning
+        """
+        self.undo_log.append((self.zobrist_key, self.castling_rights, self.en_passant_square, self.halfmove_clock,
+                              self.pawn_key, self.white_score, self.black_score))
+        # positions before a null move are not repeated by the moves after it
+        self.halfmove_clock = 0
+        self.zobrist_key ^= ZOBRIST_BLACK_TO_MOVE
+        if self.en_passant_square != ():
+            self.zobrist_key ^= ZOBRIST_EN_PASSANT[self.en_passant_square[1]]
+            self.en_passant_square = ()
+        self.white_to_move = not self.white_to_move
+
+    def undo_null_move(self):
+        self.white_to_move = not self.white_to_move
+        self.zobrist_key, self.castling_rights, self.en_passant_square, self.halfmove_clock, \
+            self.pawn_key, self.white_score, self.black_score = self.undo_log.pop()
+        self.checkmate = False
+        self.stalemate = False
+
+    def update_zobrist_key(self, move, old_castling_rights, old_en_passant_square):
+        """
+        Incrementally updates the zobrist key after make_move has changed the board
+        """
+        key = self.zobrist_key ^ ZOBRIST_BLACK_TO_MOVE
+        start = move.initial_pos_x * COLS + move.initial_pos_y
+        end = move.final_pos_x * COLS + move.final_pos_y
+        key ^= ZOBRIST_PIECES[move.piece_moved][start]
+        key ^= ZOBRIST_PIECES[self.board[move.final_pos_x][move.final_pos_y]][end]
+        if move.piece_captured != '--':
+            if move.is_en_passant_move:
+                key ^= ZOBRIST_PIECES[move.piece_captured][move.initial_pos_x * COLS + move.final_pos_y]
+            else:
+                key ^= ZOBRIST_PIECES[move.piece_captured][end]
+        if move.is_castle_move:
+            rook = move.piece_moved[0] + 'R'
+            if move.final_pos_y - move.initial_pos_y == 2:
+                key ^= ZOBRIST_PIECES[rook][end + 1] ^ ZOBRIST_PIECES[rook][end - 1]
+            else:
+                key ^= ZOBRIST_PIECES[rook][end - 2] ^ ZOBRIST_PIECES[rook][end + 1]
+        if old_en_passant_square != ():
+            key ^= ZOBRIST_EN_PASSANT[old_en_passant_square[1]]
+        if self.en_passant_square != ():
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant_square[1]]
+        key ^= ZOBRIST_CASTLING[old_castling_rights] ^ ZOBRIST_CASTLING[self.castling_rights]
+        self.zobrist_key = key
+        if move.piece_moved[1] == 'p' or move.piece_captured[1] == 'p':
+            self.pawn_key ^= self.pawn_key_change(move)
+
+    def pawn_key_change(self, move):
+        """
+        What a pawn move or pawn capture XORs into the pawn key
+        """
+        change = 0
+        if move.piece_moved[1] == 'p':
+            change ^= ZOBRIST_PIECES[move.piece_moved][move.initial_pos_x * COLS + move.initial_pos_y]
+            if not move.is_pawn_promotion:
+                change ^= ZOBRIST_PIECES[move.piece_moved][move.final_pos_x * COLS + move.final_pos_y]
+        if move.piece_captured[1] == 'p':
+            row = move.initial_pos_x if move.is_en_passant_move else move.final_pos_x
+            change ^= ZOBRIST_PIECES[move.piece_captured][row * COLS + move.final_pos_y]
+        return change
+
+    def update_scores(self, move):
+        """
+        Adds the change in material + piece square value caused by the move to the
+        score of each side
+        """
+        start = move.initial_pos_x * COLS + move.initial_pos_y
+        end = move.final_pos_x * COLS + move.final_pos_y
+        color = move.piece_moved[0]
+        placed = color + move.promotion_piece if move.is_pawn_promotion else move.piece_moved
+        delta = SQUARE_VALUES[placed][end] - SQUARE_VALUES[move.piece_moved][start]
+        if move.is_castle_move:
+            rook = SQUARE_VALUES[color + 'R']
+            if move.final_pos_y - move.initial_pos_y == 2:
+                delta += rook[end - 1] - rook[end + 1]
+            else:
+                delta += rook[end + 1] - rook[end - 2]
+        captured = 0
+        if move.piece_captured != '--':
+            if move.is_en_passant_move:
+                captured = SQUARE_VALUES[move.piece_captured][move.initial_pos_x * COLS + move.final_pos_y]
+            else:
+                captured = SQUARE_VALUES[move.piece_captured][end]
+        if color == 'w':
+            self.white_score += delta
+            self.black_score -= captured
+        else:
+            self.black_score += delta
+            self.white_score -= captured
+
+    def compute_scores(self):
+        """
+        Computes the material + piece square score of both sides from scratch
+        """
+        self.white_score = 0
+        self.black_score = 0
+        for row in range(ROWS):
+            for col in range(COLS):
+                piece = self.board[row][col]
+                if piece[0] == 'w':
+                    self.white_score += SQUARE_VALUES[piece][row * COLS + col]
+                elif piece[0] == 'b':
+                    self.black_score += SQUARE_VALUES[piece][row * COLS + col]
+
+    def compute_zobrist_key(self):
+        """
+        Computes the zobrist key of the current position from scratch
+        """
+        key = 0
+        for row in range(ROWS):
+            for col in range(COLS):
+                if self.board[row][col] != '--':
+                    key ^= ZOBRIST_PIECES[self.board[row][col]][row * COLS + col]
+        if self.en_passant_square != ():
+            key ^= ZOBRIST_EN_PASSANT[self.en_passant_square[1]]
+        key ^= ZOBRIST_CASTLING[self.castling_rights]
+        if not self.white_to_move:
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        return key
+
+    def compute_pawn_key(self):
+        """
+        Computes the zobrist key of the pawns from scratch
+        """
+        key = 0
+        for row in range(ROWS):
+            for col in range(COLS):
+                if self.board[row][col][1] == 'p':
+                    key ^= ZOBRIST_PIECES[self.board[row][col]][row * COLS + col]
+        return key
 
     def undo_move(self):
+        """
+        Takes back the last move: the pieces are put back from the move and the
+        rest of the state is restored from its undo record
+        """
         if len(self.move_log) != 0:
             move = self.move_log.pop()
+            self.zobrist_key, self.castling_rights, self.en_passant_square, self.halfmove_clock, \
+                self.pawn_key, self.white_score, self.black_score = self.undo_log.pop()
             self.board[move.initial_pos_x][move.initial_pos_y] = move.piece_moved
             self.board[move.final_pos_x][move.final_pos_y] = move.piece_captured
             self.white_to_move = not self.white_to_move     # swtiching turns
@@ -90,13 +388,6 @@ class GameState():
             if move.is_en_passant_move:
                 self.board[move.final_pos_x][move.final_pos_y] = '--'
                 self.board[move.initial_pos_x][move.final_pos_y] = move.piece_captured
-                self.en_passant_square = (move.final_pos_x, move.final_pos_y)
-            # undo 2 square pawn move
-            if move.piece_moved[1] == 'p' and abs(move.final_pos_x - move.initial_pos_x) == 2:
-                self.en_passant_square = ()
-            # undo castling rights
-            self.castle_log.pop()
-            self.castling.wks, self.castling.wqs, self.castling.bks, self.castling.wqs = self.castle_log[-1]
             # undo castle move
             if move.is_castle_move:
                 # kingside castle
@@ -113,58 +404,42 @@ class GameState():
 
             if self.stalemate:
                 self.stalemate = False
-            
-            if self.three_move_draw:
-                self.three_move_draw = False
 
-    class Castling():
+    def repetitions(self):
         """
-        Keeps track of which side we are able to castle
+        Number of times the current position occurred before. Only positions since
+        the last capture or pawn move can come back, and only every second one has
+        the same side to move.
         """
-        def __init__(self, wks, wqs, bks, bqs):
-            self.wks = wks
-            self.wqs = wqs
-            self.bks = bks
-            self.bqs = bqs
+        key = self.zobrist_key
+        log = self.undo_log
+        count = 0
+        for back in range(4, min(self.halfmove_clock, len(log)) + 1, 2):
+            if log[-back][0] == key:
+                count += 1
+        return count
 
-    def check_three_move_draw(self):
-        if len(self.move_log) >= 10:
-            if self.move_log[-1].move_id == self.move_log[-5].move_id == self.move_log[-9].move_id and \
-            self.move_log[-2].move_id == self.move_log[-6].move_id == self.move_log[-10].move_id:
-                self.three_move_draw = True
+    @property
+    def three_move_draw(self):
+        return self.repetitions() >= 2
 
-    def update_castling_rights(self, move):
-        piece = move.piece_moved[1]
-        color = move.piece_moved[0]
-        i_x = move.initial_pos_x
-        i_y = move.initial_pos_y
-        if piece == 'K':
-            if color == 'w':
-                self.castling.wks = False
-                self.castling.wqs = False
-            elif color == 'b':
-                self.castling.bks = False
-                self.castling.bqs = False
-        elif piece == 'R':
-            if color == 'w':
-                if (i_x, i_y) == (7, 0):
-                    self.castling.wqs = False
-                elif (i_x, i_y) == (7, 7):
-                    self.castling.wks = False
-            elif color == 'b':
-                if (i_x, i_y) == (0, 0):
-                    self.castling.bqs = False
-                elif (i_x, i_y) == (0, 7):
-                    self.castling.bks = False
-        # rook gets captured
-        if self.castling.wks and self.board[7][7] != 'wR':
-            self.castling.wks = False
-        if self.castling.wqs and self.board[7][0] != 'wR':
-            self.castling.wqs = False
-        if self.castling.bks and self.board[0][7] != 'bR':
-            self.castling.bks = False
-        if self.castling.bqs and self.board[0][0] != 'bR':
-            self.castling.bqs = False
+    @property
+    def fifty_move_draw(self):
+        return self.halfmove_clock >= 100
+
+    @property
+    def insufficient_material(self):
+        """
+        Neither side can mate: only the kings are left, with at most one bishop or knight
+        """
+        minor_pieces = 0
+        for row in self.board:
+            for square in row:
+                if square[1] in 'pRQ':
+                    return False
+                if square[1] in 'NB':
+                    minor_pieces += 1
+        return minor_pieces <= 1
 
     def in_range(self, row, col):
         """
@@ -200,6 +475,32 @@ class GameState():
         """
         All legal moves for a given game state with considering checks
         """
+        moves = self.generate_moves(True, True)
+        if moves == []:
+            if self.in_check:
+                self.checkmate = True
+            else:
+                self.stalemate = True
+        return moves
+
+    def get_capture_moves(self):
+        """
+        Legal captures and promotions only, the moves quiescence search looks at
+        """
+        return self.generate_moves(True, False)
+
+    def get_quiet_moves(self):
+        """
+        Legal moves that are neither captures nor promotions
+        """
+        return self.generate_moves(False, True)
+
+    def generate_moves(self, captures, quiets):
+        """
+        Legal moves of the kinds asked for: captures (with promotions) and quiet moves
+        """
+        self.generate_captures = captures
+        self.generate_quiets = quiets
         if self.white_to_move:
             color = 'w'
             king_row = self.white_king_location[0]
@@ -218,33 +519,160 @@ class GameState():
                 check_row = check[0]
                 check_col = check[1]
                 piece_checking = self.board[check_row][check_col][1]
-                valid_squares = []
+                valid_squares = set()
                 if piece_checking == 'N':
-                    valid_squares = [(check_row, check_col)]
+                    valid_squares.add((check_row, check_col))
                 else:   # block or capture
                     for i in range(1, 8):
                         valid_square = (king_row + check[2] * i, king_col + check[3] * i)
-                        valid_squares.append(valid_square)
+                        valid_squares.add(valid_square)
                         if valid_square[0] == check_row and valid_square[1] == check_col:
                             # capturing the piece
                             break
-                # remove invalid moves
-                for i in range(len(moves) - 1, -1, -1):
-                    if moves[i].piece_moved[1] != 'K':
-                        if not (moves[i].final_pos_x, moves[i].final_pos_y) in valid_squares:
-                            moves.remove(moves[i])
+                # keep king moves, moves onto the valid squares and en passant
+                # captures of a checking pawn
+                moves = [move for move in moves if move.piece_moved[1] == 'K' or
+                         (move.final_pos_x, move.final_pos_y) in valid_squares or
+                         (move.is_en_passant_move and (move.initial_pos_x, move.final_pos_y) == (check_row, check_col))]
             else:
                 self.king_moves(king_row, king_col, color, moves)
         else:
             moves = self.get_possible_moves()
-
-        if moves == []:
-            if self.in_check:
-                self.checkmate = True
-            else:
-                self.stalemate = True
         return moves
 
+    def get_attacked_squares(self):
+        """
+        Squares attacked by the side not to move, as a list of 64 booleans indexed
+        by row * 8 + col. The king of the side to move is left out so that squares
+        behind it on a checking line count as attacked. Computed once per position.
+        """
+        if self.attack_map_key == self.zobrist_key:
+            return self.attack_map
+        if self.white_to_move:
+            rival_color = 'b'
+            king_row, king_col = self.white_king_location
+            pawn_direction = 1
+        else:
+            rival_color = 'w'
+            king_row, king_col = self.black_king_location
+            pawn_direction = -1
+        board = self.board
+        attacked = [False] * 64
+        for row in range(ROWS):
+            for col in range(COLS):
+                square = board[row][col]
+                if square[0] != rival_color:
+                    continue
+                piece_type = square[1]
+                if piece_type == 'p':
+                    for c in (col - 1, col + 1):
+                        if 0 <= c < COLS and 0 <= row + pawn_direction < ROWS:
+                            attacked[(row + pawn_direction) * 8 + c] = True
+                elif piece_type == 'N' or piece_type == 'K':
+                    for d in (KNIGHT_OFFSETS if piece_type == 'N' else KING_OFFSETS):
+                        final_row, final_col = row + d[0], col + d[1]
+                        if 0 <= final_row < ROWS and 0 <= final_col < COLS:
+                            attacked[final_row * 8 + final_col] = True
+                else:
+                    for d in SLIDER_DIRECTIONS[piece_type]:
+                        final_row, final_col = row + d[0], col + d[1]
+                        while 0 <= final_row < ROWS and 0 <= final_col < COLS:
+                            attacked[final_row * 8 + final_col] = True
+                            if board[final_row][final_col] != '--' and \
+                                (final_row != king_row or final_col != king_col):
+                                break
+                            final_row += d[0]
+                            final_col += d[1]
+        self.attack_map = attacked
+        self.attack_map_key = self.zobrist_key
+        return attacked
+
+    def has_non_pawn_material(self):
+        """
+        Checks if the side to move has a piece other than pawns and king
+        """
+        color = 'w' if self.white_to_move else 'b'
+        for row in self.board:
+            for square in row:
+                if square[0] == color and square[1] not in 'pK':
+                    return True
+        return False
+
+    def see(self, move, values=SEE_VALUES):
+        """
+        Static exchange evaluation: material won by the side to move with the
+        move when both sides then recapture on its final square with their least
+        valuable piece, each side free to stop when recapturing loses. Pins are
+        not looked at.
+        """
+        gains = [values[move.piece_captured[1]] if move.is_capture else 0]
+        on_square = move.piece_moved[1]
+        if move.is_pawn_promotion:
+            gains[0] += values[move.promotion_piece] - values['p']
+            on_square = move.promotion_piece
+        for attacker in self.exchange_attackers(move):
+            gains.append(values[on_square] - gains[-1])
+            on_square = attacker
+        for i in range(len(gains) - 1, 0, -1):
+            gains[i - 1] = -max(-gains[i - 1], gains[i])
+        return gains[0]
+
+    def exchange_attackers(self, move):
+        """
+        Yields the types of the pieces recapturing on the final square of the
+        move, the sides taking turns with their least valuable attacker until one
+        has none left. Pieces that have captured uncover the sliders behind them.
+        """
+        row, col = move.final_pos_x, move.final_pos_y
+        removed = {(move.initial_pos_x, move.initial_pos_y)}
+        if move.is_en_passant_move:
+            removed.add((move.initial_pos_x, move.final_pos_y))
+        color = 'b' if move.piece_moved[0] == 'w' else 'w'
+        while True:
+            attacker = self.least_valuable_attacker(row, col, color, removed)
+            if attacker is None:
+                return
+            removed.add(attacker)
+            yield self.board[attacker[0]][attacker[1]][1]
+            color = 'b' if color == 'w' else 'w'
+
+    def least_valuable_attacker(self, row, col, color, removed):
+        """
+        (row, col) of the least valuable piece of color attacking the square,
+        None if there is none. Squares in removed count as empty.
+        """
+        board = self.board
+        pawn_row = row + 1 if color == 'w' else row - 1
+        if 0 <= pawn_row < ROWS:
+            for c in (col - 1, col + 1):
+                if 0 <= c < COLS and board[pawn_row][c] == color + 'p' and (pawn_row, c) not in removed:
+                    return pawn_row, c
+        for d_row, d_col in KNIGHT_OFFSETS:
+            r, c = row + d_row, col + d_col
+            if 0 <= r < ROWS and 0 <= c < COLS and board[r][c] == color + 'N' and (r, c) not in removed:
+                return r, c
+        best = None
+        best_rank = len(SEE_ORDER)
+        for j, (d_row, d_col) in enumerate(KING_OFFSETS):
+            slider = 'R' if j < 4 else 'B'
+            r, c = row + d_row, col + d_col
+            distance = 1
+            while 0 <= r < ROWS and 0 <= c < COLS:
+                square = board[r][c]
+                if square != '--' and (r, c) not in removed:
+                    piece_type = square[1]
+                    if square[0] == color and (piece_type == slider or piece_type == 'Q' or
+                                               (piece_type == 'K' and distance == 1)):
+                        rank = SEE_ORDER.index(piece_type)
+                        if rank < best_rank:
+                            best = (r, c)
+                            best_rank = rank
+                    break
+                r += d_row
+                c += d_col
+                distance += 1
+        return best
+
     def get_possible_moves(self,):
         """
         All possible moves for a given game state without considering checks
@@ -310,7 +738,7 @@ class GameState():
                                 checks.append((final_row, final_col, d[0], d[1]))
                             else:
                                 pins.append(possible_pin)
-                                break
+                            break
                         else:
                             break
         # knight checks
@@ -350,8 +778,9 @@ class GameState():
             move_col = col
             if self.in_range(move_row, col):
                 if self.is_empty(move_row, col):
-                    if not piece_pinned or pin_direction == (direction, 0):
-                        possible_moves.append(Move((row, col), (move_row, move_col), self.board))
+                    if (not piece_pinned or pin_direction in ((direction, 0), (-direction, 0))) and \
+                        (self.generate_captures if move_row == 0 or move_row == 7 else self.generate_quiets):
+                        self.add_pawn_move((row, col), (move_row, move_col), possible_moves)
 
                 else:
                     break
@@ -359,6 +788,8 @@ class GameState():
                 break
         
         # diagonal moves
+        if not self.generate_captures:
+            return
         move_row = row + direction
         r = 3 if self.board[row][col][0] == 'w' else 4
         for c in [-1, 1]:
@@ -367,14 +798,41 @@ class GameState():
                 if self.has_piece(move_row, move_col) and \
                     self.has_enemy_piece(move_row, move_col, color):
                     if not piece_pinned or pin_direction == (direction, c):
-                        possible_moves.append(Move((row, col), (move_row, move_col), self.board))
+                        self.add_pawn_move((row, col), (move_row, move_col), possible_moves)
                 
                 # en passant
                 elif (row == r) and \
                     (move_row, move_col) == self.en_passant_square:
-                    if not piece_pinned or pin_direction == (direction, c):
+                    if (not piece_pinned or pin_direction == (direction, c)) and \
+                        not self.en_passant_exposes_king(row, col, move_row, move_col):
                         possible_moves.append(Move((row, col), (move_row, move_col), self.board, is_en_passant_move = True))
 
+    def en_passant_exposes_king(self, row, col, move_row, move_col):
+        """
+        Checks if an en passant capture leaves the king in check, which the pin
+        scan misses when both pawns shielded the king on the same rank
+        """
+        pawn = self.board[row][col]
+        captured = self.board[row][move_col]
+        self.board[row][col] = '--'
+        self.board[row][move_col] = '--'
+        self.board[move_row][move_col] = pawn
+        in_check = self.check_for_pins_and_checks()[0]
+        self.board[row][col] = pawn
+        self.board[row][move_col] = captured
+        self.board[move_row][move_col] = '--'
+        return in_check
+
+    def add_pawn_move(self, initial, final, possible_moves):
+        """
+        Adds a pawn move, or one move for each piece it can promote to
+        """
+        if final[0] == 0 or final[0] == 7:
+            for promotion_piece in PROMOTION_PIECES:
+                possible_moves.append(Move(initial, final, self.board, promotion_piece = promotion_piece))
+        else:
+            possible_moves.append(Move(initial, final, self.board))
+
     def knight_moves(self, row, col, color, possible_moves):
         """
         Get all possible moves for knights
@@ -400,7 +858,8 @@ class GameState():
             move_row, move_col = row + knight_move[0], col + knight_move[1]
             if self.in_range(move_row, move_col) and \
                 not self.has_friendly_piece(move_row, move_col, color):
-                if not piece_pinned:
+                if not piece_pinned and \
+                    (self.generate_captures if self.has_piece(move_row, move_col) else self.generate_quiets):
                     possible_moves.append(Move((row, col), (move_row, move_col), self.board))
 
     def straight_moves(self, row, col, color, incrs, possible_moves):
@@ -421,14 +880,16 @@ class GameState():
             move_row, move_col = row + incr_row, col + incr_col
             while self.in_range(move_row, move_col):
                 if self.is_empty(move_row, move_col):
-                    if not piece_pinned or pin_direction == (incr_row, incr_col):
+                    if self.generate_quiets and \
+                        (not piece_pinned or pin_direction in ((incr_row, incr_col), (-incr_row, -incr_col))):
                         possible_moves.append(Move((row, col), (move_row, move_col), self.board))
                     
                     move_row += incr_row
                     move_col += incr_col
 
                 elif self.has_enemy_piece(move_row, move_col, color):
-                    if not piece_pinned or pin_direction == (incr_row, incr_col):
+                    if self.generate_captures and \
+                        (not piece_pinned or pin_direction in ((incr_row, incr_col), (-incr_row, -incr_col))):
                         possible_moves.append(Move((row, col), (move_row, move_col), self.board))
                     break
 
@@ -489,27 +950,15 @@ class GameState():
             (1, -1),
             (1, 1)
         ]
-
         def can_move(move_row, move_col):
-            # move king temporarily
-            if self.white_to_move:
-                self.white_king_location = (move_row, move_col)
-            else:
-                self.black_king_location = (move_row, move_col)
-            in_check, pins, checks = self.check_for_pins_and_checks()
-                
-            # move king back to original square
-            if self.white_to_move:
-                self.white_king_location = (row, col)
-            else:
-                self.black_king_location = (row, col)
+            # the attack map is only built once a square needs it
+            return not self.get_attacked_squares()[move_row * 8 + move_col]
 
-            return not in_check
-        
         for king_move in king_moves:
             move_row, move_col = row + king_move[0], col + king_move[1]
             if self.in_range(move_row, move_col) and \
-                not self.has_friendly_piece(move_row, move_col, color):
+                not self.has_friendly_piece(move_row, move_col, color) and \
+                (self.generate_captures if self.has_piece(move_row, move_col) else self.generate_quiets):
                 if can_move(move_row, move_col):
                     possible_moves.append(Move((row, col), (move_row, move_col), self.board))
                     
@@ -518,14 +967,14 @@ class GameState():
             """
             Castling moves
             """
-            if self.in_check:
+            if self.in_check or not self.generate_quiets:
                 return      # cannot castle while in check
-            if (self.white_to_move and self.castling.wks) or (not self.white_to_move and self.castling.bks):
+            if self.castling_rights & (WHITE_KING_SIDE if self.white_to_move else BLACK_KING_SIDE):
                 # king side castling
                 if self.board[row][col+1] == '--' and self.board[row][col+2] == '--':
                     if can_move(row, col+1) and can_move(row, col+2):
                         possible_moves.append(Move((row, col), (row, col+2), self.board, is_castle_move = True))
-            if (self.white_to_move and self.castling.wqs) or (not self.white_to_move and self.castling.bqs):
+            if self.castling_rights & (WHITE_QUEEN_SIDE if self.white_to_move else BLACK_QUEEN_SIDE):
                 # queen side castling
                 if self.board[row][col-1] == '--' and self.board[row][col-2] == '--' and \
                 self.board[row][col-3] == '--':
@@ -535,34 +984,105 @@ class GameState():
         castle_moves()
 
 class Move():
+    """
+    A move together with what is needed to make and undo it.
+    move_id packs the move into one int: the start square in bits 0-5, the end
+    square in bits 6-11 (squares numbered row * 8 + col) and the index of the
+    promotion piece in PROMOTION_PIECES in bits 12-13.
+    """
+    __slots__ = ('initial_pos_x', 'initial_pos_y', 'final_pos_x', 'final_pos_y', 'piece_moved',
+                 'piece_captured', 'is_capture', 'move_id', 'move_score', 'is_pawn_promotion',
+                 'promotion_piece', 'is_en_passant_move', 'is_castle_move')
 
-    def __init__(self, initial, final, board, is_en_passant_move = False, is_castle_move = False):
-        
-        self.initial_pos_x = initial[0]
-        self.initial_pos_y = initial[1]
-        self.final_pos_x = final[0]
-        self.final_pos_y = final[1]
-        self.piece_moved = board[self.initial_pos_x][self.initial_pos_y]
-        self.piece_captured = board[self.final_pos_x][self.final_pos_y]
-        self.is_capture = False
-        if self.piece_captured != '--':
-            self.is_capture = True
-        self.move_id = (self.initial_pos_x) * 1000 + (self.initial_pos_y) * 100 + \
-                        (self.final_pos_x) * 10 + (self.final_pos_y)
+    def __init__(self, initial, final, board, is_en_passant_move = False, is_castle_move = False,
+                 promotion_piece = 'Q'):
+        initial_x, initial_y = initial
+        final_x, final_y = final
+        self.initial_pos_x = initial_x
+        self.initial_pos_y = initial_y
+        self.final_pos_x = final_x
+        self.final_pos_y = final_y
+        piece_moved = board[initial_x][initial_y]
+        self.piece_moved = piece_moved
+        # en passant captures the pawn beside the starting square
+        if is_en_passant_move:
+            self.piece_captured = board[initial_x][final_y]
+        else:
+            self.piece_captured = board[final_x][final_y]
+        self.is_capture = self.piece_captured != '--'
+        self.move_id = (initial_x << 3 | initial_y) | (final_x << 3 | final_y) << 6 | \
+            PROMOTION_INDEX[promotion_piece] << 12
         self.move_score = 0
         # pawn promotion
-        self.is_pawn_promotion = (self.piece_moved == 'wp' and self.final_pos_x == 0) or \
-            (self.piece_moved == 'bp' and self.final_pos_x == 7)
-        # en passant
+        self.is_pawn_promotion = piece_moved[1] == 'p' and (final_x == 0 or final_x == 7)
+        self.promotion_piece = promotion_piece
         self.is_en_passant_move = is_en_passant_move
-        if self.is_en_passant_move:
-            self.piece_captured = board[self.initial_pos_x][self.final_pos_y]
-        # castling
         self.is_castle_move = is_castle_move
 
     def __eq__(self, other):
         if isinstance(other, Move):
             return self.move_id == other.move_id
-        
 
+    def __hash__(self):
+        return self.move_id
+
+    def get_notation(self):
+        """
+        Long algebraic notation of the move, e.g. e2e4 or e7e8n
+        """
+        notation = square_name(self.initial_pos_x, self.initial_pos_y) + \
+            square_name(self.final_pos_x, self.final_pos_y)
+        if self.is_pawn_promotion:
+            notation += self.promotion_piece.lower()
+        return notation
+
+def square_name(row, col):
+    """
+    Converts board coordinates to a square name, (7, 4) is e1
+    """
+    return FILES[col] + str(ROWS - row)
+
+def parse_square(name):
+    """
+    Converts a square name to board coordinates, e1 is (7, 4)
+    """
+    return ROWS - int(name[1]), FILES.index(name[0])
+
+# Per-function timing hooks. enable_timing swaps the methods below for wrappers
+# that add every call to timings, disable_timing puts the originals back, so the
+# hooks cost nothing while they are off.
+TIMED_METHODS = ('get_valid_moves', 'get_capture_moves', 'get_quiet_moves', 'generate_moves',
+                 'check_for_pins_and_checks', 'get_attacked_squares', 'make_move', 'undo_move', '__init__')
+timings = {}    # 'Class.method': [calls, seconds]
+_untimed = {}   # (class, method name): original function
+
+def _timed(name, function):
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timing = timings[name]
+            timing[0] += 1
+            timing[1] += time.perf_counter() - start
+    return timed
+
+def enable_timing(classes=()):
+    """
+    Times the TIMED_METHODS defined by GameState, Move and the given subclasses.
+    GameState.__init__ is left alone, game states are not made during a search.
+    """
+    for cls in (GameState, Move) + tuple(classes):
+        for method in TIMED_METHODS:
+            if method not in cls.__dict__ or (cls, method) in _untimed or \
+                (cls is GameState and method == '__init__'):
+                continue
+            name = cls.__name__ + '.' + method
+            timings.setdefault(name, [0, 0.0])
+            _untimed[(cls, method)] = cls.__dict__[method]
+            setattr(cls, method, _timed(name, cls.__dict__[method]))
 
+def disable_timing():
+    for (cls, method), function in _untimed.items():
+        setattr(cls, method, function)
+    _untimed.clear()
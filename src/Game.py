@@ -1,5 +1,7 @@
+import copy
+import queue
+import threading
 import pygame as p
-from ChessEngine import GameState
 from ChessEngine import Move
 import Searcher as Searcher
 
@@ -7,6 +9,7 @@ HEIGHT = WIDTH = 512
 ROWS = COLS = 8
 SQ_LEN = HEIGHT // ROWS
 MAX_FPS = 15    # for animations
+THINK_TIME = 5  # seconds the engine may spend on a move
 # colors
 DARK = (121, 96, 76)
 LIGHT = (171, 149, 132)
@@ -15,13 +18,27 @@ PURPLE = (125, 122, 223)
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 
+# piece images and the empty board, drawn once by load_graphics
+images = {}
+board_surface = None
+
+def load_graphics():
+    """
+    Loads the piece images once, converted for fast blitting and scaled to a
+    square, and pre-renders the empty board. Needs the display to be set up.
+    """
+    global board_surface
+    for piece in ['wp', 'wR', 'wN', 'wB', 'wQ', 'wK', 'bp', 'bR', 'bN', 'bB', 'bQ', 'bK']:
+        image = p.image.load(f"assets/images/{piece}.png").convert_alpha()
+        images[piece] = p.transform.smoothscale(image, (SQ_LEN, SQ_LEN))
+    board_surface = p.Surface((WIDTH, HEIGHT)).convert()
+    show_board(board_surface)
+
 # show methods
 def show_board(chess_board):
     """
     Displays the chess board
     """
-    global colors
-    colors = [LIGHT, DARK]
     cnt = 0
     for row in range(ROWS):
         for col in range(COLS):
@@ -32,32 +49,48 @@ def show_board(chess_board):
             cnt += 1
         cnt += 1
 
-def show_pieces(chess_board, gs):
+def show_square(chess_board, row, col, piece, highlight=None):
     """
-    Displays the pieces over the board
+    Draws one square with its highlight and piece, returns the square's rect
     """
-    for row in range(ROWS):
-        for col in range(COLS):
-            piece = gs.board[row][col]
-            if piece != '--':
-                chess_board.blit(p.image.load(f"assets/images/{piece}.png"), 
-                                 p.Rect(SQ_LEN*col, SQ_LEN*row, SQ_LEN, SQ_LEN))
+    square = p.Rect(SQ_LEN*col, SQ_LEN*row, SQ_LEN, SQ_LEN)
+    chess_board.blit(board_surface, square, square)
+    if highlight is not None:
+        s = p.Surface((SQ_LEN, SQ_LEN))
+        s.set_alpha(100)    # transparency
+        s.fill(highlight)
+        chess_board.blit(s, square)
+    if piece != '--':
+        chess_board.blit(images[piece], square)
+    return square
 
-def show_moves(chess_board, gs, valid_moves, sq_selected):
+def squares_to_show(gs, valid_moves, sq_selected):
     """
-    Highlights valid move squares
+    The piece and highlight color that should be shown on every square.
+    The selected piece and the squares it can move to are highlighted.
     """
+    highlights = {}
     if sq_selected != ():
         row, col = sq_selected
         if gs.board[row][col][0] == ('w' if gs.white_to_move else 'b'):
-            s = p.Surface((SQ_LEN, SQ_LEN))
-            s.set_alpha(100)    # transparency
-            s.fill(PURPLE)
-            chess_board.blit(s, (col * SQ_LEN, row * SQ_LEN))
+            highlights[(row, col)] = PURPLE
             for move in valid_moves:
                 if move.initial_pos_x == row and move.initial_pos_y == col:
-                    s.fill(BLUE)
-                    chess_board.blit(s, (move.final_pos_y * SQ_LEN, move.final_pos_x * SQ_LEN))
+                    highlights[(move.final_pos_x, move.final_pos_y)] = BLUE
+    return [[(gs.board[row][col], highlights.get((row, col))) for col in range(COLS)] for row in range(ROWS)]
+
+def show_changes(chess_board, shown, squares):
+    """
+    Redraws only the squares that differ from what is shown on screen,
+    shown is None when the whole board has to be drawn. Returns the dirty rects.
+    """
+    dirty = []
+    for row in range(ROWS):
+        for col in range(COLS):
+            if shown is None or shown[row][col] != squares[row][col]:
+                piece, highlight = squares[row][col]
+                dirty.append(show_square(chess_board, row, col, piece, highlight))
+    return dirty
 
 def show_text(chess_board, text):
     font = p.font.SysFont('helvetica', 25, True, False)
@@ -69,26 +102,60 @@ def show_text(chess_board, text):
     chess_board.blit(text_object, text_location.move(2, 2))
 
 def animate_move(move, chess_board, board, clock):
-    global colors
+    """
+    Slides the moved piece to its square, redrawing only the squares it crosses
+    """
     dr = move.final_pos_x - move.initial_pos_x
     dc = move.final_pos_y - move.initial_pos_y
     frames_per_square = 5   # animation speed
     frames_count = (abs(dr) + abs(dc)) * frames_per_square
+    top, bottom = sorted((move.initial_pos_x, move.final_pos_x))
+    left, right = sorted((move.initial_pos_y, move.final_pos_y))
+    area = p.Rect(left*SQ_LEN, top*SQ_LEN, (right-left+1)*SQ_LEN, (bottom-top+1)*SQ_LEN)
     for frame in range(frames_count+1):
         row, col = (move.initial_pos_x + dr * frame/frames_count, move.initial_pos_y + dc * frame/frames_count)
-        show_board(chess_board)
-        show_pieces(chess_board, board)
-
-        color = colors[(move.final_pos_x + move.final_pos_y) % 2]
-        end_square = p.Rect(move.final_pos_y*SQ_LEN, move.final_pos_x*SQ_LEN, SQ_LEN, SQ_LEN)
-        p.draw.rect(chess_board, color, end_square)
+        for r in range(top, bottom+1):
+            for c in range(left, right+1):
+                show_square(chess_board, r, c, board.board[r][c])
+        # the end square stays empty until the piece arrives
+        show_square(chess_board, move.final_pos_x, move.final_pos_y, '--')
 
         # draw moving piece
-        chess_board.blit(p.image.load(f"assets/images/{move.piece_moved}.png"), 
-                                 p.Rect(SQ_LEN*col, SQ_LEN*row, SQ_LEN, SQ_LEN))
-        p.display.flip()
+        chess_board.blit(images[move.piece_moved], p.Rect(SQ_LEN*col, SQ_LEN*row, SQ_LEN, SQ_LEN))
+        p.display.update(area)
         clock.tick(50)
 
+# only one search may use the Searcher module at a time
+search_lock = threading.Lock()
+
+def start_search(gs):
+    """
+    Starts the engine search on a copy of the game state in a background thread.
+    Returns the queue the move is put on and the event that cancels the search.
+    """
+    results = queue.Queue()
+    cancelled = threading.Event()
+    search_gs = copy.deepcopy(gs)
+
+    def search():
+        with search_lock:
+            if not cancelled.is_set():
+                results.put(Searcher.find_move(search_gs, search_gs.get_valid_moves(), time_limit=THINK_TIME,
+                                               cancel_event=cancelled))
+
+    threading.Thread(target=search, daemon=True).start()
+    return results, cancelled
+
+def cancel_search(search):
+    """
+    Stops a running search, its result is never read. The search checks the event
+    itself, a Searcher.stop() made before it reset its stop flag would be lost.
+    """
+    if search is not None:
+        results, cancelled = search
+        cancelled.set()
+    return None
+
 def main():
     """
     The main driver function
@@ -96,8 +163,9 @@ def main():
     p.init()    # initialize all imported p modules
     chess_board = p.display.set_mode((HEIGHT, WIDTH))
     p.display.set_caption('chess')
+    load_graphics()
     clock = p.time.Clock()
-    gs = GameState()
+    gs = Searcher.new_game_state()
     sq_selected = ()
     player_clicks = []
 
@@ -108,10 +176,14 @@ def main():
     player_two = False  # same for black
     animate = True
     running = True
+    search = None   # results queue and cancel event of the running engine search
+    shown = None    # squares currently on screen, None forces a full redraw
+    text_shown = False
     while running:
         human_turn = (gs.white_to_move and player_one) or (not gs.white_to_move and player_two)
         for event in p.event.get():
             if event.type == p.QUIT:
+                search = cancel_search(search)
                 running = False
 
             # mouse handler
@@ -142,45 +214,70 @@ def main():
             # key handler                
             elif event.type == p.KEYDOWN:
                 if event.key == p.K_z:
+                    search = cancel_search(search)
                     gs.undo_move()
                     move_made = True
                     if game_over:
                         game_over = False
+                        text_shown = False
+                        shown = None
 
         if move_made:
             if animate:
                 animate_move(gs.move_log[-1], chess_board, gs, clock)
+                shown = None
             valid_moves = gs.get_valid_moves()
             move_made = False
         
+        text = None
         if gs.checkmate:
             game_over = True
             if gs.white_to_move:
                 text = 'Black wins by checkmate'
             else:
                 text = 'White wins by checkmate'
-            show_text(chess_board, text)
 
         elif gs.stalemate:
             game_over = True
             text = 'Draw by stalemate'
-            show_text(chess_board, text)
             
         elif gs.three_move_draw:
             game_over = True
             text = 'Draw by repitition'
-            show_text(chess_board, text)
 
-        if not game_over and not human_turn:
-            ai_move = Searcher.find_move(gs, valid_moves)
-            gs.make_move(ai_move)
-            move_made = True
+        elif gs.fifty_move_draw:
+            game_over = True
+            text = 'Draw by fifty move rule'
+
+        elif gs.insufficient_material:
+            game_over = True
+            text = 'Draw by insufficient material'
+
+        if not game_over and not human_turn and not move_made:
+            if search is None:
+                search = start_search(gs)
+            elif not search[0].empty():
+                # the move was found on a copy, play the equal move of this game state
+                ai_move = search[0].get()
+                search = None
+                for move in valid_moves:
+                    if move == ai_move:
+                        gs.make_move(move)
+                        move_made = True
 
         clock.tick(MAX_FPS)
-        p.display.flip()
-        show_board(chess_board)
-        show_moves(chess_board, gs, valid_moves, sq_selected)
-        show_pieces(chess_board, gs)
+        # draw only what changed, an idle board costs nothing
+        squares = squares_to_show(gs, valid_moves, sq_selected)
+        dirty = show_changes(chess_board, shown, squares)
+        shown = squares
+        if text is not None and not text_shown:
+            show_text(chess_board, text)
+            text_shown = True
+            dirty = [chess_board.get_rect()]
+        # an engine move made this frame is animated next frame and the board redrawn
+        # after it, flushing its end position now would flash it before the animation
+        if dirty and not (move_made and animate):
+            p.display.update(dirty)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
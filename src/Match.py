@@ -0,0 +1,367 @@
+"""
+Engine vs engine matches: plays two configurations of Searcher against each
+other in a pool of processes and tells whether the second one is stronger.
+
+Every opening is played twice, each engine taking white once. An engine is a
+JSON object, given inline or as the path of a file, with any of
+    "name"          shown in the report
+    "settings"      Searcher constants to play with, e.g. {"DEPTH": 4, "USE_LMR": false}
+    "parameters"    a parameter file written by Tuner.py
+    "time", "nodes" limits of every search, instead of the ones of the match
+Games end by the rules, checked on the GameState, or are adjudicated: won once
+both engines agree on a winning score for a few moves, drawn once they agree the
+game is level late into it, and drawn at the ply limit. The Elo difference and
+the sequential probability ratio test of the second engine against the first
+are reported as the games come in, and the match stops as soon as the test
+accepts one of its hypotheses.
+
+    python src/Match.py --second '{"settings": {"USE_LMR": false}}' --games 1000
+    python src/Match.py --openings openings.epd --second tuned.json --nodes 5000 --elo1 10
+"""
+import argparse
+import collections
+import json
+import math
+import os
+import sys
+import time
+from multiprocessing import Pool
+import ChessEngine as ChessEngine
+import Searcher as Searcher
+import Book as Book
+
+WORKERS = os.cpu_count() or 1
+GAMES = 200
+DEPTH = 3
+# megabytes of transposition table of each engine in each worker
+HASH_SIZE_MB = 4
+# plies after which a game is drawn
+MAX_PLIES = 300
+# a game is won once both engines have scored it at least RESIGN_SCORE for the winner
+# for the last RESIGN_PLIES plies, and drawn once they have scored it within
+# DRAW_SCORE of level for the last DRAW_PLIES plies, from DRAW_MIN_PLY on
+RESIGN_SCORE = 1000
+RESIGN_PLIES = 6
+DRAW_SCORE = 10
+DRAW_PLIES = 16
+DRAW_MIN_PLY = 80
+# games between two progress lines
+REPORT_INTERVAL = 10
+
+class Engine():
+    """
+    One side of the match: the Searcher settings it plays with, its search limits
+    and, in the worker processes, its own search tables
+    """
+    def __init__(self, name, settings, parameters, depth, time_limit, node_limit):
+        self.name = name
+        self.settings = settings
+        self.parameters = parameters    # (piece values, tables) for Searcher.set_parameters
+        self.depth = depth
+        self.time_limit = time_limit
+        self.node_limit = node_limit
+
+    def prepare(self):
+        """
+        Creates the tables the engine keeps between its searches
+        """
+        self.tt = Searcher.TranspositionTable(HASH_SIZE_MB)
+        self.history = [0] * len(Searcher.history)
+        self.killers = [[0, 0] for _ in range(Searcher.MAX_PLY)]
+
+    def activate(self, gs):
+        """
+        Makes Searcher play as this engine in the game state
+        """
+        for name, value in self.settings.items():
+            setattr(Searcher, name, value)
+        Searcher.set_parameters(*self.parameters)
+        Searcher.pawn_cache.clear()
+        Searcher.tt = self.tt
+        Searcher.history = self.history
+        Searcher.killers = self.killers
+        # the scores kept by the game state follow the piece square tables
+        gs.compute_scores()
+
+    def find_move(self, gs):
+        self.activate(gs)
+        depth = self.depth if self.time_limit is None and self.node_limit is None else Searcher.MAX_PLY
+        move = Searcher.find_move(gs, gs.get_valid_moves(), depth, self.time_limit, self.node_limit)
+        return move, Searcher.best_score
+
+def default_parameters():
+    """
+    Searcher's current piece values and tables, as set_parameters takes them
+    """
+    return dict(Searcher.piece), {k: [value - Searcher.piece[k] for value in table]
+                                  for k, table in Searcher.pst.items()}
+
+def load_engine(spec, name, depth, time_limit, node_limit):
+    """
+    Engine from a JSON object, or from the path of a file holding one
+    """
+    if os.path.exists(spec):
+        with open(spec) as spec_file:
+            spec = spec_file.read()
+    config = json.loads(spec)
+    settings = config.get('settings', {})
+    for key in settings:
+        if not key.isupper() or not hasattr(Searcher, key):
+            raise ValueError(f"Searcher has no setting {key}")
+    parameters = Searcher.read_parameters(config['parameters']) if 'parameters' in config \
+        else default_parameters()
+    return Engine(config.get('name', name), dict(settings), parameters, settings.get('DEPTH', depth),
+                  config.get('time', time_limit), config.get('nodes', node_limit))
+
+def read_openings(path):
+    """
+    FENs of an EPD or FEN file, one position per line, '#' starting a comment
+    """
+    openings = []
+    with open(path) as openings_file:
+        for line in openings_file:
+            fields = line.split('#')[0].split(';')[0].split()
+            if len(fields) < 2:
+                continue
+            # EPD lines carry operations after the four position fields
+            counters = fields[4:6] if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit() else []
+            fen = ' '.join(fields[:4] + counters)
+            ChessEngine.GameState().load_fen(fen)
+            openings.append(fen)
+    return openings
+
+def book_openings():
+    """
+    The positions at the end of the lines of the test book, used without an openings file
+    """
+    openings = []
+    for line in Book.TEST_LINES:
+        gs = ChessEngine.GameState()
+        for notation, weight in line:
+            gs.make_move(gs.parse_move(notation))
+        openings.append(gs.get_fen())
+    return openings
+
+def adjudicate(gs, scores):
+    """
+    (result for white, reason) of a finished game, (None, None) while it goes
+    on. scores are the search scores of the moves played, from white's side.
+    """
+    if gs.get_valid_moves() == []:
+        if gs.checkmate:
+            return (0.0 if gs.white_to_move else 1.0), 'checkmate'
+        return 0.5, 'stalemate'
+    if gs.fifty_move_draw:
+        return 0.5, 'fifty moves'
+    if gs.three_move_draw:
+        return 0.5, 'repetition'
+    if gs.insufficient_material:
+        return 0.5, 'insufficient material'
+    if len(gs.move_log) >= MAX_PLIES:
+        return 0.5, 'ply limit'
+    recent = scores[-RESIGN_PLIES:]
+    if len(recent) == RESIGN_PLIES:
+        if all(score >= RESIGN_SCORE for score in recent):
+            return 1.0, 'adjudicated win'
+        if all(score <= -RESIGN_SCORE for score in recent):
+            return 0.0, 'adjudicated win'
+    recent = scores[-DRAW_PLIES:]
+    if len(gs.move_log) >= DRAW_MIN_PLY and len(recent) == DRAW_PLIES and \
+        all(abs(score) <= DRAW_SCORE for score in recent):
+        return 0.5, 'adjudicated draw'
+    return None, None
+
+# the engines of a worker process, set up by init_worker
+engines = None
+
+def init_worker(match_engines):
+    global engines
+    engines = match_engines
+    Searcher.USE_BOOK = False
+    for engine in engines:
+        engine.prepare()
+
+def play_game(job):
+    """
+    Plays one game in a worker process. job is (game number, opening, index of the
+    engine playing white). Returns (game number, result for white, reason, plies,
+    index of the white engine).
+    """
+    game, fen, white = job
+    gs = Searcher.new_game_state()
+    gs.load_fen(fen)
+    for engine in engines:
+        engine.tt.clear()
+    scores = []
+    while True:
+        result, reason = adjudicate(gs, scores)
+        if result is not None:
+            return game, result, reason, len(gs.move_log), white
+        engine = engines[white if gs.white_to_move else 1 - white]
+        move, score = engine.find_move(gs)
+        scores.append(score if gs.white_to_move else -score)
+        gs.make_move(move)
+
+def elo(score):
+    if score <= 0:
+        return -math.inf
+    if score >= 1:
+        return math.inf
+    return 400 * math.log10(score / (1 - score))
+
+def expected_score(elo_difference):
+    return 1 / (1 + 10 ** (-elo_difference / 400))
+
+class MatchStats():
+    """
+    Wins, draws and losses of the second engine, its Elo difference to the first
+    and the log likelihood ratio of the sequential probability ratio test of
+    elo1 against elo0, with the game results taken as normally distributed
+    """
+    def __init__(self, elo0, elo1, alpha, beta):
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower_bound = math.log(beta / (1 - alpha))
+        self.upper_bound = math.log((1 - beta) / alpha)
+        self.wins = self.draws = self.losses = 0
+        self.reasons = collections.Counter()
+        self.plies = 0
+
+    def add(self, score, reason, plies):
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+        self.reasons[reason] += 1
+        self.plies += plies
+
+    @property
+    def games(self):
+        return self.wins + self.draws + self.losses
+
+    def score(self):
+        return (self.wins + self.draws / 2) / self.games
+
+    def variance(self):
+        """
+        Variance of the result of one game
+        """
+        score = self.score()
+        return (self.wins * (1 - score) ** 2 + self.draws * (0.5 - score) ** 2 +
+                self.losses * score ** 2) / self.games
+
+    def elo(self):
+        """
+        (Elo difference, its 95% error margin)
+        """
+        score = self.score()
+        margin = 1.96 * math.sqrt(self.variance() / self.games)
+        return elo(score), (elo(min(score + margin, 1)) - elo(max(score - margin, 0))) / 2
+
+    def llr(self):
+        variance = self.variance()
+        if variance == 0:
+            return 0.0
+        s0 = expected_score(self.elo0)
+        s1 = expected_score(self.elo1)
+        return self.games * (s1 - s0) * (2 * self.score() - s0 - s1) / (2 * variance)
+
+    def sprt(self):
+        """
+        'H1' when the second engine is elo1 stronger, 'H0' when it is at most elo0, else None
+        """
+        llr = self.llr()
+        if llr >= self.upper_bound:
+            return 'H1'
+        if llr <= self.lower_bound:
+            return 'H0'
+        return None
+
+def run_match(first, second, openings, games, workers, stats, stop_early=True, report=sys.stderr):
+    """
+    Plays the games over the pool and adds their results to stats. Returns the
+    games per hour.
+    """
+    jobs = [(game, openings[(game // 2) % len(openings)], game % 2) for game in range(games)]
+    start = time.perf_counter()
+    with Pool(workers, initializer=init_worker, initargs=([first, second],)) as pool:
+        for game, result, reason, plies, white in pool.imap_unordered(play_game, jobs):
+            # results are kept for the second engine, which plays white in odd games
+            stats.add(result if white == 1 else 1 - result, reason, plies)
+            decision = stats.sprt()
+            if report is not None and (stats.games % REPORT_INTERVAL == 0 or decision is not None):
+                difference, margin = stats.elo()
+                hours = (time.perf_counter() - start) / 3600
+                print(f"games {stats.games}  +{stats.wins} ={stats.draws} -{stats.losses}  "
+                      f"elo {difference:+.1f} +/- {margin:.1f}  "
+                      f"llr {stats.llr():.2f} ({stats.lower_bound:.2f}, {stats.upper_bound:.2f})  "
+                      f"{stats.games / hours:.0f} games/hour", file=report)
+            if stop_early and decision is not None:
+                break
+    return stats.games / ((time.perf_counter() - start) / 3600)
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"{text} is not a positive number")
+    return value
+
+def finite_or_none(value, digits=1):
+    """
+    The value rounded, None when it is infinite or undefined, which JSON has no number for.
+    The Elo difference is infinite when one engine won every game.
+    """
+    return round(value, digits) if math.isfinite(value) else None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Play two engine configurations against each other')
+    parser.add_argument('--first', default='{}', help='engine JSON or file, the baseline')
+    parser.add_argument('--second', default='{}', help='engine JSON or file, the one tested')
+    parser.add_argument('--openings', help='EPD or FEN file, the test book lines by default')
+    parser.add_argument('--games', type=positive_int, default=GAMES)
+    parser.add_argument('--workers', type=positive_int, default=WORKERS)
+    parser.add_argument('--depth', type=int, default=DEPTH)
+    parser.add_argument('--time', type=float, help='seconds per move instead of a depth')
+    parser.add_argument('--nodes', type=int, help='nodes per move instead of a depth')
+    parser.add_argument('--elo0', type=float, default=0.0, help='Elo gain of the null hypothesis')
+    parser.add_argument('--elo1', type=float, default=5.0, help='Elo gain of the alternative hypothesis')
+    parser.add_argument('--alpha', type=float, default=0.05)
+    parser.add_argument('--beta', type=float, default=0.05)
+    parser.add_argument('--no-stop', action='store_true', help='play all games even once the test has decided')
+    args = parser.parse_args(argv)
+
+    first = load_engine(args.first, 'first', args.depth, args.time, args.nodes)
+    second = load_engine(args.second, 'second', args.depth, args.time, args.nodes)
+    # both engines set every setting either one changes, so neither inherits the other's
+    for engine, other in ((first, second), (second, first)):
+        for key in other.settings:
+            engine.settings.setdefault(key, getattr(Searcher, key))
+    openings = read_openings(args.openings) if args.openings else book_openings()
+    if openings == []:
+        print('no openings to play', file=sys.stderr)
+        return 1
+
+    stats = MatchStats(args.elo0, args.elo1, args.alpha, args.beta)
+    games_per_hour = run_match(first, second, openings, args.games, args.workers, stats, not args.no_stop)
+    difference, margin = stats.elo()
+    print(json.dumps({
+        'first': first.name,
+        'second': second.name,
+        'games': stats.games,
+        'wins': stats.wins,
+        'draws': stats.draws,
+        'losses': stats.losses,
+        'elo': finite_or_none(difference),
+        'elo_margin': finite_or_none(margin),
+        'llr': round(stats.llr(), 3),
+        'sprt': stats.sprt(),
+        'average_plies': round(stats.plies / stats.games, 1) if stats.games else 0,
+        'games_per_hour': round(games_per_hour),
+        'endings': dict(stats.reasons),
+    }, indent=2, allow_nan=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
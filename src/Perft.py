@@ -0,0 +1,134 @@
+"""
+Perft: counts the leaf nodes of the legal move tree to a fixed depth and checks
+them against known values, which catches move generation and make/undo bugs.
+Also reports the throughput of get_valid_moves + make_move + undo_move.
+
+    python src/Perft.py --depth 3
+    python src/Perft.py --position kiwipete --depth 2 --divide --json
+    python src/Perft.py --fen "8/8/8/8/8/8/8/K6k w - - 0 1" --depth 4
+"""
+import argparse
+import json
+import sys
+import time
+from ChessEngine import GameState, START_FEN
+from BitboardEngine import BitboardGameState
+
+# reference positions and their node counts, index i holds perft(i)
+POSITIONS = {
+    'startpos': (START_FEN, [1, 20, 400, 8902, 197281, 4865609]),
+    'kiwipete': ('r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+                 [1, 48, 2039, 97862, 4085603]),
+    'position3': ('8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+                  [1, 14, 191, 2812, 43238, 674624]),
+    'position4': ('r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1',
+                  [1, 6, 264, 9467, 422333]),
+    'position5': ('rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8',
+                  [1, 44, 1486, 62379, 2103487]),
+}
+
+def perft(gs, depth):
+    """
+    Number of leaf nodes of the legal move tree of the given depth
+    """
+    if depth == 0:
+        return 1
+    nodes = 0
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        nodes += perft(gs, depth-1)
+        gs.undo_move()
+    return nodes
+
+def divide(gs, depth):
+    """
+    Perft split by root move, the first thing to compare when a count is wrong
+    """
+    counts = {}
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        counts[move.get_notation()] = perft(gs, depth-1) if depth > 0 else 1
+        gs.undo_move()
+    return counts
+
+def run_position(name, fen, depth, expected=None, show_divide=False, state_class=GameState):
+    """
+    Runs perft on a position and returns the result as a dictionary
+    """
+    gs = state_class()
+    gs.load_fen(fen)
+    fen_before = gs.get_fen()
+    key_before = gs.zobrist_key
+    start = time.perf_counter()
+    if show_divide:
+        moves = divide(gs, depth)
+        nodes = sum(moves.values())
+    else:
+        moves = None
+        nodes = perft(gs, depth)
+    elapsed = time.perf_counter() - start
+    result = {
+        'position': name,
+        'fen': fen,
+        'depth': depth,
+        'nodes': nodes,
+        'expected': expected,
+        'passed': expected is None or nodes == expected,
+        # make/undo must leave the position exactly as it was
+        'state_restored': gs.get_fen() == fen_before and gs.zobrist_key == key_before,
+        'seconds': round(elapsed, 4),
+        'nps': int(nodes / elapsed) if elapsed > 0 else 0,
+    }
+    if moves is not None:
+        result['divide'] = moves
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move generation perft test and benchmark')
+    parser.add_argument('--position', choices=sorted(POSITIONS), action='append',
+                        help='reference position to run, may be repeated (default: all)')
+    parser.add_argument('--fen', help='run a custom position instead of the reference positions')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--divide', action='store_true', help='report node counts per root move')
+    parser.add_argument('--bitboard', action='store_true', help='use the bitboard game state')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+    state_class = BitboardGameState if args.bitboard else GameState
+
+    if args.fen:
+        runs = [('fen', args.fen, None)]
+    else:
+        runs = []
+        for name in args.position or sorted(POSITIONS):
+            fen, counts = POSITIONS[name]
+            runs.append((name, fen, counts[args.depth] if args.depth < len(counts) else None))
+
+    results = [run_position(name, fen, args.depth, expected, args.divide, state_class)
+               for name, fen, expected in runs]
+    total_nodes = sum(result['nodes'] for result in results)
+    total_seconds = sum(result['seconds'] for result in results)
+    report = {
+        'state': state_class.__name__,
+        'depth': args.depth,
+        'results': results,
+        'total_nodes': total_nodes,
+        'total_seconds': round(total_seconds, 4),
+        'nps': int(total_nodes / total_seconds) if total_seconds > 0 else 0,
+        'passed': all(result['passed'] and result['state_restored'] for result in results),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for result in results:
+            for move, count in result.get('divide', {}).items():
+                print(f"{move}: {count}")
+            status = 'ok' if result['passed'] and result['state_restored'] else 'FAILED'
+            expected = result['expected'] if result['expected'] is not None else '?'
+            print(f"{result['position']:<10} depth {args.depth}  nodes {result['nodes']:>9}  "
+                  f"expected {expected:>9}  {result['seconds']:>8.3f}s  {result['nps']:>8} nps  {status}")
+        print(f"total {total_nodes} nodes in {total_seconds:.3f}s, {report['nps']} nps")
+    return 0 if report['passed'] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Profiles a search from a given position: runs find_move under cProfile and
+writes the hottest functions to <output>.txt, then runs it again under a
+sampling profiler and writes the sampled call stacks to <output>.collapsed, the
+folded format read by flamegraph.pl and speedscope. The two runs are separate
+so that neither profiler skews the other.
+
+    python src/Profile.py --depth 5
+    python src/Profile.py --fen "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1" --time 10
+    python src/Profile.py --depth 4 --timing --output kiwipete
+"""
+import argparse
+import cProfile
+import io
+import os
+import pstats
+import signal
+import sys
+import ChessEngine as ChessEngine
+import Searcher as Searcher
+from BitboardEngine import BitboardGameState
+
+# seconds of cpu time between two stack samples
+SAMPLE_INTERVAL = 0.001
+
+def new_search(fen, state_class):
+    """
+    The position to search, with the transposition table emptied
+    """
+    gs = state_class()
+    gs.load_fen(fen)
+    Searcher.tt.clear()
+    return gs
+
+def search(gs, depth, time_limit):
+    """
+    One search without the opening book
+    """
+    use_book = Searcher.USE_BOOK
+    Searcher.USE_BOOK = False
+    try:
+        return Searcher.find_move(gs, gs.get_valid_moves(), depth, time_limit, return_stats=True)
+    finally:
+        Searcher.USE_BOOK = use_book
+
+def frame_name(frame):
+    code = frame.f_code
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return module + '.' + getattr(code, 'co_qualname', code.co_name)
+
+def sample_stacks(fen, depth, time_limit, state_class):
+    """
+    Counts of the call stacks seen by a SIGPROF timer during a search, keyed by
+    the stack in collapsed form: names from the outermost frame in, split by ';'
+    """
+    stacks = {}
+    gs = new_search(fen, state_class)
+
+    def sample(signum, frame):
+        names = []
+        while frame is not None:
+            names.append(frame_name(frame))
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        stacks[stack] = stacks.get(stack, 0) + 1
+
+    previous = signal.signal(signal.SIGPROF, sample)
+    signal.setitimer(signal.ITIMER_PROF, SAMPLE_INTERVAL, SAMPLE_INTERVAL)
+    try:
+        search(gs, depth, time_limit)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, previous)
+    return stacks
+
+def report(profiler, stats, top):
+    """
+    The search statistics and the functions taking the most time, by own time and
+    by time including the functions they call
+    """
+    out = io.StringIO()
+    out.write(f"best move {stats.best_move}, depth {len(stats.iterations)}, {stats.nodes} nodes "
+              f"({stats.quiescence_nodes} quiescence) in {stats.seconds:.3f}s under the profiler\n\n")
+    for sort in ('tottime', 'cumulative'):
+        out.write(f"sorted by {sort}\n")
+        pstats.Stats(profiler, stream=out).strip_dirs().sort_stats(sort).print_stats(top)
+    if ChessEngine.timings:
+        out.write('timing hooks\n')
+        for name, (calls, seconds) in sorted(ChessEngine.timings.items(), key=lambda item: -item[1][1]):
+            out.write(f"{name:<45} {calls:>9} calls {seconds:>9.3f}s "
+                      f"{seconds / calls * 1e6 if calls else 0:>9.1f}us per call\n")
+    return out.getvalue()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Profile a search from a position')
+    parser.add_argument('--fen', default=ChessEngine.START_FEN)
+    parser.add_argument('--depth', type=int, default=Searcher.DEPTH)
+    parser.add_argument('--time', type=float, help='time limit of the search in seconds')
+    parser.add_argument('--bitboard', action='store_true', help='use the bitboard game state')
+    parser.add_argument('--timing', action='store_true', help='also time calls with the ChessEngine hooks')
+    parser.add_argument('--top', type=int, default=30, help='number of functions in the report')
+    parser.add_argument('--output', default='profile', help='path of the output files without extension')
+    args = parser.parse_args(argv)
+    state_class = BitboardGameState if args.bitboard else ChessEngine.GameState
+    depth = args.depth if args.time is None else Searcher.MAX_PLY
+
+    gs = new_search(args.fen, state_class)
+    if args.timing:
+        ChessEngine.enable_timing([state_class])
+    profiler = cProfile.Profile()
+    profiler.enable()
+    move, stats = search(gs, depth, args.time)
+    profiler.disable()
+    ChessEngine.disable_timing()
+    with open(args.output + '.txt', 'w') as output:
+        output.write(report(profiler, stats, args.top))
+    print(f"wrote {args.output}.txt")
+
+    if hasattr(signal, 'setitimer'):
+        stacks = sample_stacks(args.fen, depth, args.time, state_class)
+        with open(args.output + '.collapsed', 'w') as output:
+            for stack, count in sorted(stacks.items()):
+                output.write(f"{stack} {count}\n")
+        print(f"wrote {args.output}.collapsed")
+    else:
+        print('no interval timers on this platform, skipped the collapsed stacks')
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,69 @@
+from array import array
+from multiprocessing import Pool, shared_memory
+import json
+import os
+import random
+import time
 import ChessEngine as ChessEngine
+from BitboardEngine import BitboardGameState
+import Book as Book
 
 ROWS = COLS = 8
 
 # tune these values to change the behaviour of the engine
 CHECKMATE = 60000
 STALEMATE = 0
+DRAW = 0
 DEPTH = 5
+HASH_SIZE_MB = 16
+# check the incrementally updated evaluation against a full recompute
+DEBUG_EVALUATION = False
+ASPIRATION_WINDOW = 50
+# the clock and stop requests are checked every CHECK_INTERVAL + 1 nodes, the node
+# limit exactly when it is reached
+CHECK_INTERVAL = 1023
+# number of processes used by find_move_parallel
+WORKERS = 4
+# random amount added to move scores by helper workers so they search in another order
+ORDER_JITTER = 50
+# move ordering: the hash move, then captures and promotions that do not lose
+# material, then the killer moves, then captures that lose material by static
+# exchange evaluation, then quiet moves ordered by their history score
+HASH_MOVE_SCORE = 1000000
+CAPTURE_SCORE = 100000
+KILLER_SCORES = (90000, 89000)
+LOSING_CAPTURE_SCORE = 70000
+HISTORY_MAX = 50000
+MAX_PLY = 128
+# more than the most legal moves any position has
+MAX_MOVES = 256
+# null move pruning: give the opponent a free move and search with reduced depth,
+# if we are still above beta the real moves will be too
+USE_NULL_MOVE = True
+NULL_MOVE_REDUCTION = 2
+NULL_MOVE_MIN_DEPTH = 3
+# late move reductions: quiet moves ordered late are first searched a ply shallower
+USE_LMR = True
+LMR_MIN_DEPTH = 3
+LMR_MIN_MOVES = 3
+# quiescence: skip captures that lose material by static exchange evaluation, and
+# captures that leave the score below alpha even winning the piece with a margin
+USE_SEE_PRUNING = True
+USE_DELTA_PRUNING = True
+DELTA_MARGIN = 200
+# pawn structure, in centipawns per pawn; passed pawns by how far they have advanced
+DOUBLED_PAWN_PENALTY = 10
+ISOLATED_PAWN_PENALTY = 15
+PASSED_PAWN_BONUS = (0, 5, 10, 20, 35, 60, 100, 0)
+# entries of the evaluation cache, keyed by position, and of the pawn structure cache
+USE_EVAL_CACHE = True
+EVAL_CACHE_SIZE = 1 << 16
+PAWN_CACHE_SIZE = 1 << 14
+# play moves from the opening book while the position is in it
+USE_BOOK = True
+BOOK_PATH = Book.TEST_BOOK
+# search on the bitboard game state, its move generation is about twice as fast as the 8x8 scans
+USE_BITBOARDS = True
 piece = {'p' : 100, 'N' : 320, 'B' : 330, 'R' : 500, 'Q' : 900, 'K' : 20000}
 
 pst = {
@@ -63,53 +121,625 @@ pst = {
              20, 20,  0,  0,  0,  0, 20, 20,
              20, 20, 30,  0,  0, 10, 30, 20),
 }
-# join piece and pst dictionaries
-for k, table in pst.items():
-    sumrow = lambda row: tuple(x + piece[k] for x in row)
-    pst[k] = sum((sumrow(table[i*8 : i*8+8]) for i in range(8)), ())
+# piece values and tables fitted by Tuner.py, used instead of the ones above when the file exists
+PARAMETERS_PATH = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                '..', 'assets', 'parameters.json'))
 
-def find_move(gs, valid_moves):
+def set_parameters(piece_values, tables):
+    """
+    Uses the given piece values and piece square tables, the tables without the
+    piece values in them. Game states created earlier need compute_scores().
+    """
+    tables = dict(tables)
+    piece.update(piece_values)
+    # join piece and pst dictionaries
+    for k, table in tables.items():
+        pst[k] = tuple(x + piece[k] for x in table)
+    ChessEngine.set_square_values(pst)
+    eval_cache.clear()
+
+def read_parameters(path):
+    """
+    (piece values, tables) of a parameter file written by Tuner.py, as set_parameters takes them
+    """
+    with open(path) as parameters:
+        parameters = json.load(parameters)
+    return ({k: int(value) for k, value in parameters['piece'].items()},
+            {k: [int(value) for value in table] for k, table in parameters['pst'].items()})
+
+def load_parameters(path):
+    """
+    Reads a parameter file written by Tuner.py and uses it
+    """
+    set_parameters(*read_parameters(path))
+
+# bound types stored in the transposition table
+EXACT = 0
+LOWER = 1
+UPPER = 2
+# scores beyond this are mate scores and are stored relative to the node in the table
+MATE_BOUND = CHECKMATE - 1000
+
+class TranspositionTable():
+    """
+    Fixed size hash table of search results indexed by zobrist key.
+    Each entry is two 64-bit words: the key xored with the data, and the data itself.
+    The data packs the score, depth, bound type, best move and search generation.
+    """
+    ENTRY_BYTES = 16
+    SCORE_OFFSET = 1 << 31
+
+    def __init__(self, size_mb=HASH_SIZE_MB, buffer=None):
+        self.probes = 0
+        self.hits = 0
+        if buffer is not None:
+            self.attach(buffer)
+        else:
+            self.resize(size_mb)
+
+    def resize(self, size_mb):
+        """
+        Allocates an empty table using at most size_mb megabytes
+        """
+        self.size = max(1, int(size_mb * 1024 * 1024) // self.ENTRY_BYTES)
+        self.table = array('Q', bytes(self.size * self.ENTRY_BYTES))
+        self.age = 0
+
+    def attach(self, buffer):
+        """
+        Uses an existing buffer, such as shared memory, as the table.
+        Entries are written without locks, a torn write fails the key check in probe.
+        """
+        self.table = memoryview(buffer).cast('Q')
+        self.size = len(self.table) // 2
+
+    def clear(self):
+        self.table[:] = array('Q', bytes(self.size * self.ENTRY_BYTES))
+
+    def new_search(self):
+        """
+        Entries from older searches are replaced first
+        """
+        self.age = (self.age + 1) & 0x3F
+        self.probes = 0
+        self.hits = 0
+
+    def probe(self, key):
+        """
+        Returns (depth, bound, score, move_id) stored for the key or None.
+        move_id is 0 when no best move is known.
+        """
+        self.probes += 1
+        index = (key % self.size) << 1
+        data = self.table[index + 1]
+        if self.table[index] ^ data != key or data == 0:
+            return None
+        self.hits += 1
+        return ((data >> 32) & 0xFF, (data >> 40) & 0x3, (data & 0xFFFFFFFF) - self.SCORE_OFFSET,
+                (data >> 42) & 0xFFFF)
+
+    def store(self, key, depth, bound, score, move_id=0):
+        """
+        Stores an entry, always replacing entries from older searches and otherwise
+        preferring the deeper result. A deeper entry of the same position is only
+        replaced by an exact score, so the depth 0 results of quiescence reaching the
+        position through a transposition do not overwrite it.
+        """
+        index = (key % self.size) << 1
+        old_data = self.table[index + 1]
+        if old_data != 0:
+            same_key = self.table[index] ^ old_data == key
+            if (old_data >> 58) == self.age and depth < ((old_data >> 32) & 0xFF) and \
+                (not same_key or bound != EXACT):
+                return
+            if same_key and move_id == 0:
+                move_id = (old_data >> 42) & 0xFFFF
+        data = (score + self.SCORE_OFFSET) | depth << 32 | bound << 40 | move_id << 42 | self.age << 58
+        self.table[index] = key ^ data
+        self.table[index + 1] = data
+
+class SearchStats():
+    """
+    Counters of one search. Every completed iteration and the totals at the end
+    are also written as JSON lines to stream, a file or a function taking the line.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+        self.main_nodes = 0
+        self.quiescence_nodes = 0
+        self.tt_probes = 0
+        self.tt_hits = 0
+        self.tt_cutoffs = 0
+        self.eval_cache_probes = 0
+        self.eval_cache_hits = 0
+        self.pawn_cache_probes = 0
+        self.pawn_cache_hits = 0
+        self.cutoffs_by_index = {}
+        self.selective_depth = 0
+        self.iterations = []
+        self.best_move = None
+        self.book_move = False
+
+    @property
+    def nodes(self):
+        return self.main_nodes + self.quiescence_nodes
+
+    @property
+    def nps(self):
+        return int(self.nodes / self.seconds) if self.seconds > 0 else 0
+
+    def update(self):
+        """
+        Copies the counters of the running search
+        """
+        self.seconds = time.perf_counter() - self.start
+        self.main_nodes = nodes - quiescence_nodes
+        self.quiescence_nodes = quiescence_nodes
+        self.tt_probes = tt.probes
+        self.tt_hits = tt.hits
+        self.tt_cutoffs = tt_cutoffs
+        self.eval_cache_probes = eval_cache.probes
+        self.eval_cache_hits = eval_cache.hits
+        self.pawn_cache_probes = pawn_cache.probes
+        self.pawn_cache_hits = pawn_cache.hits
+        self.cutoffs_by_index = {index: count for index, count in enumerate(cutoff_counts) if count}
+        self.selective_depth = max(self.selective_depth, selective_depth)
+
+    def add_iteration(self, depth, score):
+        """
+        Records a completed iteration. The effective branching factor is the ratio
+        of its nodes to the nodes of the iteration before.
+        """
+        searched = sum(iteration['nodes'] for iteration in self.iterations)
+        seconds = sum(iteration['seconds'] for iteration in self.iterations)
+        self.update()
+        iteration = {
+            'depth': depth,
+            'score': score,
+            'nodes': self.nodes - searched,
+            'seconds': round(self.seconds - seconds, 6),
+            'ebf': None,
+            'selective_depth': selective_depth,
+        }
+        if self.iterations and self.iterations[-1]['nodes'] > 0:
+            iteration['ebf'] = round(iteration['nodes'] / self.iterations[-1]['nodes'], 3)
+        self.iterations.append(iteration)
+        self.emit(dict(iteration, type='iteration'))
+
+    def finish(self, move):
+        self.update()
+        self.best_move = move.get_notation() if move is not None else None
+        self.emit(dict(self.to_dict(), type='search'))
+
+    def to_dict(self):
+        return {
+            'best_move': self.best_move,
+            'book_move': self.book_move,
+            'seconds': round(self.seconds, 6),
+            'nodes': self.nodes,
+            'main_nodes': self.main_nodes,
+            'quiescence_nodes': self.quiescence_nodes,
+            'nps': self.nps,
+            'tt_probes': self.tt_probes,
+            'tt_hits': self.tt_hits,
+            'tt_cutoffs': self.tt_cutoffs,
+            'eval_cache_probes': self.eval_cache_probes,
+            'eval_cache_hits': self.eval_cache_hits,
+            'pawn_cache_probes': self.pawn_cache_probes,
+            'pawn_cache_hits': self.pawn_cache_hits,
+            'cutoffs_by_index': self.cutoffs_by_index,
+            'selective_depth': self.selective_depth,
+            'iterations': self.iterations,
+        }
+
+    def emit(self, record):
+        if self.stream is None:
+            return
+        line = json.dumps(record)
+        if callable(self.stream):
+            self.stream(line)
+        else:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+class ScoreCache():
+    """
+    Fixed size table of scores by hash key. A new entry replaces whatever was in
+    its slot, so the table never grows.
+    """
+    def __init__(self, size):
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = size
+        self.keys = array('Q', bytes(8 * size))
+        self.scores = array('i', bytes(4 * size))
+        self.probes = 0
+        self.hits = 0
+
+    def clear(self):
+        self.resize(self.size)
+
+    def probe(self, key):
+        """
+        The score stored for the key, None when it is not in the table
+        """
+        self.probes += 1
+        index = key % self.size
+        if self.keys[index] == key:
+            self.hits += 1
+            return self.scores[index]
+        return None
+
+    def store(self, key, score):
+        index = key % self.size
+        self.keys[index] = key
+        self.scores[index] = score
+
+    def hit_rate(self):
+        return self.hits / self.probes if self.probes else 0.0
+
+tt = TranspositionTable()
+eval_cache = ScoreCache(EVAL_CACHE_SIZE)
+pawn_cache = ScoreCache(PAWN_CACHE_SIZE)
+set_parameters(piece, pst)
+if os.path.exists(PARAMETERS_PATH):
+    load_parameters(PARAMETERS_PATH)
+nodes = 0
+quiescence_nodes = 0
+# deepest ply reached in the current iteration, quiescence included
+selective_depth = 0
+tt_cutoffs = 0
+stopped = False
+deadline = None
+max_nodes = None
+best_move = None
+best_score = 0
+completed_depth = 0
+order_jitter = None
+# one byte of shared memory that ends the searches of all Lazy SMP workers
+shared_stop = None
+# threading.Event set by another thread to end the search
+stop_event = None
+book = None
+# two quiet moves per ply that recently caused a beta cutoff
+killers = [[0, 0] for _ in range(MAX_PLY)]
+# butterfly history of quiet cutoffs, indexed by side to move, start and end square
+history = [0] * (2 * 64 * 64)
+# beta cutoffs in pvs by the index of the move that caused them
+cutoff_counts = [0] * MAX_MOVES
+# statistics of the last search
+stats = None
+
+def set_book(path):
+    """
+    Uses the polyglot book at path, None turns book probing off
+    """
+    global USE_BOOK
+    global BOOK_PATH
+    global book
+    if book is not None:
+        book.close()
+        book = None
+    USE_BOOK = path is not None
+    BOOK_PATH = path
+
+def probe_book(gs, valid_moves):
+    """
+    A move from the opening book, None when book probing is off or the position is not in the book
+    """
+    global book
+    if not USE_BOOK:
+        return None
+    if book is None:
+        if not os.path.exists(BOOK_PATH) or os.path.getsize(BOOK_PATH) == 0:
+            return None
+        book = Book.OpeningBook(BOOK_PATH)
+    return book.find_move(gs, valid_moves)
+
+def new_game_state():
+    """
+    Game state of the class the engine searches on, set by USE_BITBOARDS
+    """
+    return BitboardGameState() if USE_BITBOARDS else ChessEngine.GameState()
+
+def set_hash_size(size_mb):
+    """
+    Sets the memory budget of the transposition table in megabytes
+    """
+    tt.resize(size_mb)
+
+def score_to_tt(score, ply):
+    """
+    Mate scores are stored as distance to mate from the stored node
+    """
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+def score_from_tt(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+def find_move(gs, valid_moves, depth=DEPTH, time_limit=None, node_limit=None, info_callback=None,
+              stats_stream=None, return_stats=False, cancel_event=None):
     """
     Root call for search
+    Searches to depth 1, 2, 3... up to depth and returns the best move of the last
+    completed iteration once the time limit (in seconds) or node limit runs out.
+    info_callback(depth, score, nodes, seconds) is called after every completed iteration.
+    The SearchStats of the search are kept in stats and streamed to stats_stream,
+    with return_stats the result is (move, stats).
+    The search also stops once cancel_event, a threading.Event, is set. Unlike stop()
+    it cannot be lost by being set before the search starts.
+    """
+    global best_move
+    global best_score
+    global nodes
+    global quiescence_nodes
+    global selective_depth
+    global tt_cutoffs
+    global stopped
+    global deadline
+    global max_nodes
+    global completed_depth
+    global stats
+    global stop_event
+    nodes = 0
+    quiescence_nodes = 0
+    selective_depth = 0
+    tt_cutoffs = 0
+    best_score = 0
+    completed_depth = 0
+    tt.new_search()
+    new_search_ordering()
+    for cache in (eval_cache, pawn_cache):
+        cache.probes = cache.hits = 0
+    stats = SearchStats(stats_stream)
+    best_move = probe_book(gs, valid_moves)
+    if best_move is not None:
+        stats.book_move = True
+        stats.finish(best_move)
+        return (best_move, stats) if return_stats else best_move
+    stopped = False
+    deadline = time.perf_counter() + time_limit if time_limit is not None else None
+    max_nodes = node_limit
+    stop_event = cancel_event
+    start = time.perf_counter()
+    turn_multiplier = 1 if gs.white_to_move else -1
+    completed_move = None
+    for current_depth in range(1, depth+1):
+        best_move = None
+        selective_depth = 0
+        score = aspiration_search(gs, current_depth, best_score, turn_multiplier)
+        if stopped:
+            break
+        completed_move = best_move
+        best_score = score
+        completed_depth = current_depth
+        stats.add_iteration(current_depth, score)
+        if info_callback is not None:
+            info_callback(current_depth, score, nodes, time.perf_counter() - start)
+    if completed_move is None:
+        # not even the first iteration finished, take whatever was found
+        completed_move = best_move if best_move is not None else valid_moves[0]
+    best_move = completed_move
+    stats.finish(best_move)
+    return (best_move, stats) if return_stats else best_move
+
+def find_move_parallel(gs, valid_moves, workers=WORKERS, depth=DEPTH, time_limit=None, node_limit=None):
+    """
+    Lazy SMP root call
+    Starts worker processes that all search the root position and share the
+    transposition table through shared memory. Odd workers aim one ply deeper
+    and all but the first search moves in a slightly shuffled order, so they
+    fill the table with different results. All workers stop as soon as one of
+    them reaches its depth, and the move of the worker that completed the
+    deepest iteration is played.
     """
     global best_move
+    global best_score
     global nodes
+    global completed_depth
     nodes = 0
-    best_move = None
-    alpha = -CHECKMATE
-    beta = CHECKMATE
-    # negamaxalphabeta(gs, DEPTH, alpha, beta, 1 if gs.white_to_move else -1)
-    pvs(gs, alpha, beta, DEPTH, 1 if gs.white_to_move else -1)
-    print(nodes)
-    if best_move == None:
-        best_move = valid_moves[0]
+    best_score = 0
+    completed_depth = 0
+    best_move = probe_book(gs, valid_moves)
+    if best_move is not None:
+        return best_move
+    tt.new_search()
+    table_bytes = tt.size * TranspositionTable.ENTRY_BYTES
+    # the byte after the table is the shared stop flag
+    shared = shared_memory.SharedMemory(create=True, size=table_bytes + 1)
+    try:
+        shared.buf[table_bytes] = 0
+        # the workers start from what this process has already learned
+        shared.buf[:table_bytes] = memoryview(tt.table).cast('B')
+        jobs = [(gs, shared.name, table_bytes, tt.age, worker, depth + worker % 2, time_limit, node_limit)
+                for worker in range(workers)]
+        with Pool(workers) as pool:
+            results = pool.starmap(parallel_worker, jobs)
+        memoryview(tt.table).cast('B')[:] = shared.buf[:table_bytes]
+    finally:
+        shared.close()
+        shared.unlink()
+
+    nodes = sum(result[3] for result in results)
+    # deepest completed iteration wins, the unperturbed first worker breaks ties
+    completed_depth, best_score, move_id, _ = max(results, key=lambda result: result[0])
+    best_move = valid_moves[0]
+    for move in valid_moves:
+        if move.move_id == move_id:
+            best_move = move
     return best_move
 
-def quiescence(gs, alpha, beta, turn_multiplier):
+def parallel_worker(gs, shared_name, table_bytes, age, worker, depth, time_limit, node_limit):
+    """
+    Runs one Lazy SMP search in a worker process on the shared transposition table
+    Returns (completed depth, score, move id, nodes)
+    """
+    global order_jitter
+    global shared_stop
+    shared = shared_memory.SharedMemory(name=shared_name)
+    try:
+        tt.attach(shared.buf[:table_bytes])
+        tt.age = age - 1
+        shared_stop = shared.buf[table_bytes:table_bytes + 1]
+        order_jitter = random.Random(worker) if worker > 0 else None
+        move = find_move(gs, gs.get_valid_moves(), depth, time_limit, node_limit)
+        result = (completed_depth, best_score, move.move_id, nodes)
+        if completed_depth == depth:
+            shared_stop[0] = 1
+        tt.table.release()
+        shared_stop.release()
+        shared_stop = None
+    finally:
+        shared.close()
+    return result
+
+def new_search_ordering():
+    """
+    Clears the killer moves and ages the history so older searches count less
+    """
+    for ply_killers in killers:
+        ply_killers[0] = ply_killers[1] = 0
+    for i in range(len(history)):
+        history[i] >>= 1
+    for i in range(MAX_MOVES):
+        cutoff_counts[i] = 0
+
+def first_move_cutoff_rate():
+    """
+    Fraction of the beta cutoffs of the last search caused by the first move tried,
+    the closer to 1 the better the move ordering
+    """
+    cutoffs = sum(cutoff_counts)
+    return cutoff_counts[0] / cutoffs if cutoffs else 0.0
+
+def principal_variation(gs, max_length=DEPTH):
+    """
+    The expected line of play, following the best moves stored in the transposition table
+    """
+    line = []
+    seen = set()
+    while len(line) < max_length and gs.zobrist_key not in seen:
+        seen.add(gs.zobrist_key)
+        entry = tt.probe(gs.zobrist_key)
+        if entry is None or entry[3] == 0:
+            break
+        move = None
+        for valid_move in gs.get_valid_moves():
+            if valid_move.move_id == entry[3]:
+                move = valid_move
+        if move is None:
+            break
+        gs.make_move(move)
+        line.append(move)
+    for move in line:
+        gs.undo_move()
+    return line
+
+def aspiration_search(gs, depth, previous_score, turn_multiplier):
+    """
+    Searches with a narrow window around the previous iteration's score,
+    widening it whenever the score falls outside
+    """
+    if depth == 1 or abs(previous_score) > MATE_BOUND:
+        return pvs(gs, -CHECKMATE, CHECKMATE, depth, turn_multiplier)
+    window = ASPIRATION_WINDOW
+    alpha = previous_score - window
+    beta = previous_score + window
+    while True:
+        score = pvs(gs, alpha, beta, depth, turn_multiplier)
+        if stopped:
+            return score
+        if score <= alpha:
+            alpha = max(alpha - window, -CHECKMATE)
+        elif score >= beta:
+            beta = min(beta + window, CHECKMATE)
+        else:
+            return score
+        window *= 4
+
+def stop():
+    """
+    Makes a running search return as soon as possible
+    """
+    global stopped
+    stopped = True
+
+def check_limits():
+    """
+    Sets the stop flag when the time or node budget is used up or the search is cancelled
+    """
+    global stopped
+    if (max_nodes is not None and nodes >= max_nodes) or \
+        (deadline is not None and time.perf_counter() >= deadline) or \
+        (shared_stop is not None and shared_stop[0]) or \
+        (stop_event is not None and stop_event.is_set()):
+        stopped = True
+
+def quiescence(gs, alpha, beta, turn_multiplier, ply=0):
     global nodes
+    global quiescence_nodes
+    global selective_depth
+    global tt_cutoffs
     nodes += 1
+    quiescence_nodes += 1
+    if ply > selective_depth:
+        selective_depth = ply
+    if nodes & CHECK_INTERVAL == 0 or nodes == max_nodes:
+        check_limits()
+    if stopped:
+        return 0
+    key = gs.zobrist_key
+    entry = tt.probe(key)
+    hash_move = 0
+    if entry is not None:
+        tt_depth, tt_bound, tt_score, hash_move = entry
+        tt_score = score_from_tt(tt_score, ply)
+        if tt_bound == EXACT or (tt_bound == LOWER and tt_score >= beta) or \
+            (tt_bound == UPPER and tt_score <= alpha):
+            tt_cutoffs += 1
+            return min(max(tt_score, alpha), beta)
     stand_pat = evaluation(gs) * turn_multiplier
     if stand_pat >= beta:
+        tt.store(key, 0, LOWER, score_to_tt(beta, ply))
         return beta
+    alpha_orig = alpha
     if alpha < stand_pat:
         alpha = stand_pat
-    valid_moves = gs.get_valid_moves()
-    captures = []
-    for m in valid_moves:
-        if m.is_capture:
-            captures.append(m)
-    order_moves(captures)
-    for capture_move in captures:
-        if not capture_move.is_capture:
+    captures = gs.get_capture_moves()
+    order_moves(captures, hash_move, gs=gs)
+    best_move_id = 0
+    for i in range(len(captures)):
+        capture_move = pick_move(captures, i)
+        if USE_SEE_PRUNING and capture_move.move_score < CAPTURE_SCORE:
+            # captures are ordered by static exchange, the rest lose material too
+            break
+        if USE_DELTA_PRUNING and capture_move.is_capture and not capture_move.is_pawn_promotion and \
+            stand_pat + piece[capture_move.piece_captured[1]] + DELTA_MARGIN <= alpha:
             continue
         gs.make_move(capture_move)
-        score = -quiescence(gs, -beta, -alpha, -turn_multiplier)
+        score = -quiescence(gs, -beta, -alpha, -turn_multiplier, ply+1)
         gs.undo_move()
+        if stopped:
+            return 0
         if score >= beta:
+            tt.store(key, 0, LOWER, score_to_tt(beta, ply), capture_move.move_id)
             return beta
         if score > alpha:
             alpha = score
+            best_move_id = capture_move.move_id
 
+    tt.store(key, 0, EXACT if alpha > alpha_orig else UPPER, score_to_tt(alpha, ply), best_move_id)
     return alpha
 
 def negamaxalphabeta(gs, depth, alpha, beta, turn_multiplier):
@@ -127,7 +757,8 @@ def negamaxalphabeta(gs, depth, alpha, beta, turn_multiplier):
         return 0
     valid_moves = gs.get_valid_moves()
     order_moves(valid_moves)
-    for move in valid_moves:
+    for i in range(len(valid_moves)):
+        move = pick_move(valid_moves, i)
         gs.make_move(move)
         score = -negamaxalphabeta(gs, depth-1, -beta, -alpha, -turn_multiplier)
         if score > max_score:
@@ -141,59 +772,199 @@ def negamaxalphabeta(gs, depth, alpha, beta, turn_multiplier):
             break
     return max_score
 
-def pvs(gs, alpha, beta, depth, turn_multiplier):
+def pvs(gs, alpha, beta, depth, turn_multiplier, ply=0, allow_null=True):
     global best_move
+    global nodes
+    global selective_depth
+    global tt_cutoffs
     if depth == 0:
-        return quiescence(gs, alpha, beta, turn_multiplier)
-    valid_moves = gs.get_valid_moves()
-    order_moves(valid_moves)
+        return quiescence(gs, alpha, beta, turn_multiplier, ply)
+    nodes += 1
+    if ply > selective_depth:
+        selective_depth = ply
+    if nodes & CHECK_INTERVAL == 0 or nodes == max_nodes:
+        check_limits()
+    if stopped:
+        return 0
+    if ply > 0 and (gs.halfmove_clock >= 100 or gs.repetitions() > 0):
+        # a repeated position is a draw, the side that is better will avoid it
+        return DRAW
+    key = gs.zobrist_key
+    entry = tt.probe(key)
+    hash_move = 0
+    if entry is not None:
+        tt_depth, tt_bound, tt_score, hash_move = entry
+        if ply > 0 and tt_depth >= depth:
+            tt_score = score_from_tt(tt_score, ply)
+            if tt_bound == EXACT or (tt_bound == LOWER and tt_score >= beta) or \
+                (tt_bound == UPPER and tt_score <= alpha):
+                tt_cutoffs += 1
+                return min(max(tt_score, alpha), beta)
+    captures = gs.get_capture_moves()
+    in_check = gs.in_check
+    if USE_NULL_MOVE and allow_null and ply > 0 and depth >= NULL_MOVE_MIN_DEPTH and not in_check and \
+        beta < MATE_BOUND and evaluation(gs) * turn_multiplier >= beta and gs.has_non_pawn_material():
+        # only pawn and king moves left is where zugzwang happens, so no null move there
+        gs.make_null_move()
+        score = -pvs(gs, -beta, -beta+1, depth-1-NULL_MOVE_REDUCTION, -turn_multiplier, ply+1, False)
+        gs.undo_null_move()
+        if stopped:
+            return 0
+        if score >= beta:
+            tt.store(key, depth, LOWER, score_to_tt(beta, ply))
+            return beta
+    white_to_move = gs.white_to_move
+    alpha_orig = alpha
+    best_move_id = 0
     bSearchPv = True
-    for move in valid_moves:
+    i = -1
+    for i, move in enumerate(staged_moves(gs, captures, hash_move, ply)):
         gs.make_move(move)
-        if bSearchPv:
-            score = -pvs(gs, -beta, -alpha, depth-1, -turn_multiplier)
-        else:
-            score = -pvs(gs, -alpha-1, -alpha, depth-1, -turn_multiplier)
-            if score > alpha:
-                score = -pvs(gs, -beta, -alpha, depth-1, -turn_multiplier)
+        score = None
+        if USE_LMR and depth >= LMR_MIN_DEPTH and i >= LMR_MIN_MOVES and not in_check and \
+            not move.is_capture and not move.is_pawn_promotion and move.move_score < KILLER_SCORES[1] and \
+            not gs.check_for_pins_and_checks()[0]:
+            # a quiet move that is not a killer and gives no check, try it shallower first. Losing
+            # captures are ordered below the killers too, but are searched to full depth.
+            reduction = 1 if i < 2 * LMR_MIN_MOVES else 2
+            score = -pvs(gs, -alpha-1, -alpha, depth-1-reduction, -turn_multiplier, ply+1)
+        if score is None or score > alpha:
+            if bSearchPv:
+                score = -pvs(gs, -beta, -alpha, depth-1, -turn_multiplier, ply+1)
+            else:
+                score = -pvs(gs, -alpha-1, -alpha, depth-1, -turn_multiplier, ply+1)
+                if score > alpha:
+                    score = -pvs(gs, -beta, -alpha, depth-1, -turn_multiplier, ply+1)
         gs.undo_move()
+        if stopped:
+            return 0
         if score >= beta:
+            tt.store(key, depth, LOWER, score_to_tt(beta, ply), move.move_id)
+            if ply == 0:
+                best_move = move
+            record_cutoff(move, depth, ply, i, white_to_move)
             return beta
         if score > alpha:
             alpha = score
-            best_move = move
+            best_move_id = move.move_id
+            if ply == 0:
+                best_move = move
             bSearchPv = False
-        
+    if i < 0:
+        return -CHECKMATE + ply if in_check else STALEMATE
+
+    tt.store(key, depth, EXACT if alpha > alpha_orig else UPPER, score_to_tt(alpha, ply), best_move_id)
     return alpha
 
-def order_moves(valid_moves):
+def staged_moves(gs, captures, hash_move, ply):
     """
-    Sort the moves according to the MVVLVA-
-    Most Valuable Victim - Least Valuable Agressor
+    Yields the legal moves of a node in stages: the hash move, the captures and
+    promotions that do not lose material by static exchange evaluation, then
+    the killer moves, the losing captures and the quiet moves by history.
+    Quiet moves are only generated when the captures ran out without a cutoff,
+    or earlier when the hash move is one of them.
     """
-    for i in range(len(valid_moves)):
-        move_score = 0
-        piece_captured = valid_moves[i].piece_captured
-        piece_moved = valid_moves[i].piece_moved
-        if valid_moves[i].piece_captured != '--':
-            move_score += 10 * piece[piece_captured[1]] - piece[piece_moved[1]]
-
-        if valid_moves[i].is_pawn_promotion:
-            move_score += piece['Q']
-
-        if valid_moves[i].is_castle_move:
-            move_score += 10000
-        
-        valid_moves[i].move_score = move_score
-    # sorting
-    for i in range(len(valid_moves)):
-        for j in range(len(valid_moves) - i - 1):
-            if valid_moves[j].move_score < valid_moves[j + 1].move_score:
-                valid_moves[j], valid_moves[j+1] = valid_moves[j+1], valid_moves[j]
+    white_to_move = gs.white_to_move
+    quiets = None
+    if hash_move and not any(move.move_id == hash_move for move in captures):
+        quiets = gs.get_quiet_moves()
+        for move in quiets:
+            if move.move_id == hash_move:
+                move.move_score = HASH_MOVE_SCORE
+                yield move
+                break
+    order_moves(captures, hash_move, gs=gs)
+    losing = len(captures)
+    for i in range(len(captures)):
+        move = pick_move(captures, i)
+        if move.move_score < CAPTURE_SCORE:
+            losing = i
+            break
+        yield move
+    if quiets is None:
+        quiets = gs.get_quiet_moves()
+    order_moves(quiets, hash_move, ply, white_to_move)
+    moves = quiets + captures[losing:]
+    for i in range(len(moves)):
+        move = pick_move(moves, i)
+        if move.move_id != hash_move:
+            yield move
+
+def order_moves(valid_moves, hash_move=0, ply=None, white_to_move=True, gs=None):
+    """
+    Scores the moves for pick_move: the move stored in the transposition table
+    first, then captures and promotions, then the killer moves of the ply, then
+    quiet moves by history. Given the game state, captures and promotions are
+    scored by static exchange evaluation and those losing material go after the
+    killer moves, otherwise by MVVLVA- Most Valuable Victim - Least Valuable Agressor
+    """
+    if ply is not None and ply < MAX_PLY:
+        killer_one, killer_two = killers[ply]
+    else:
+        killer_one = killer_two = 0
+    side = 0 if white_to_move else 4096
+    for move in valid_moves:
+        move_id = move.move_id
+        if move_id == hash_move:
+            move_score = HASH_MOVE_SCORE
+        elif (move.is_capture or move.is_pawn_promotion) and gs is not None:
+            exchange = gs.see(move)
+            move_score = (CAPTURE_SCORE if exchange >= 0 else LOSING_CAPTURE_SCORE) + exchange
+        elif move.is_capture or move.is_pawn_promotion:
+            move_score = CAPTURE_SCORE
+            if move.is_capture:
+                move_score += 10 * piece[move.piece_captured[1]] - piece[move.piece_moved[1]]
+            if move.is_pawn_promotion:
+                move_score += piece[move.promotion_piece]
+        elif move_id == killer_one:
+            move_score = KILLER_SCORES[0]
+        elif move_id == killer_two:
+            move_score = KILLER_SCORES[1]
+        else:
+            move_score = history[side | (move_id & 0xFFF)]
+            if move.is_castle_move:
+                move_score += 10000
+
+        if order_jitter is not None:
+            move_score += order_jitter.randrange(ORDER_JITTER)
+
+        move.move_score = move_score
+
+def pick_move(valid_moves, i):
+    """
+    Selection sort step: swaps the best scored of the remaining moves to index i
+    and returns it, so moves after a cutoff are never sorted
+    """
+    best = i
+    best_score = valid_moves[i].move_score
+    for j in range(i + 1, len(valid_moves)):
+        if valid_moves[j].move_score > best_score:
+            best = j
+            best_score = valid_moves[j].move_score
+    valid_moves[i], valid_moves[best] = valid_moves[best], valid_moves[i]
+    return valid_moves[i]
+
+def record_cutoff(move, depth, ply, move_index, white_to_move):
+    """
+    Remembers a quiet move that caused a beta cutoff as killer and in the history
+    """
+    cutoff_counts[move_index] += 1
+    if move.is_capture or move.is_pawn_promotion:
+        return
+    if ply < MAX_PLY and killers[ply][0] != move.move_id:
+        killers[ply][1] = killers[ply][0]
+        killers[ply][0] = move.move_id
+    index = (0 if white_to_move else 4096) | (move.move_id & 0xFFF)
+    history[index] += depth * depth
+    if history[index] > HISTORY_MAX:
+        for j in range(len(history)):
+            history[j] >>= 1
 
 def evaluation(gs):
     """
     Returns the evaluation of a state
+    The material + piece square score is kept up to date by the game state, the
+    pawn structure score comes from the pawn cache and the sum is cached by position
     """
     if gs.checkmate:
         if gs.white_to_move:
@@ -202,7 +973,59 @@ def evaluation(gs):
             return CHECKMATE
     if gs.stalemate:
         return STALEMATE
-    
+
+    if USE_EVAL_CACHE:
+        evaluation = eval_cache.probe(gs.zobrist_key)
+        if evaluation is not None and not DEBUG_EVALUATION:
+            return evaluation
+    pawn_score = pawn_cache.probe(gs.pawn_key)
+    if pawn_score is None:
+        pawn_score = pawn_structure(gs)
+        pawn_cache.store(gs.pawn_key, pawn_score)
+    evaluation = gs.white_score - gs.black_score + pawn_score
+    if DEBUG_EVALUATION:
+        full_evaluation = evaluate_board(gs)
+        assert evaluation == full_evaluation, \
+            f"incremental evaluation {evaluation} != {full_evaluation} for {gs.get_fen()}"
+    if USE_EVAL_CACHE:
+        eval_cache.store(gs.zobrist_key, evaluation)
+    return evaluation
+
+def pawn_structure(gs):
+    """
+    Doubled, isolated and passed pawn score, white minus black. A pawn is passed
+    when no enemy pawn stands in front of it on its own or a neighbouring file.
+    """
+    white_pawns = [[] for _ in range(COLS)]     # rows of the pawns on every file
+    black_pawns = [[] for _ in range(COLS)]
+    for row in range(ROWS):
+        for col in range(COLS):
+            square = gs.board[row][col]
+            if square == 'wp':
+                white_pawns[col].append(row)
+            elif square == 'bp':
+                black_pawns[col].append(row)
+    score = 0
+    for own, rival, sign in ((white_pawns, black_pawns, 1), (black_pawns, white_pawns, -1)):
+        for col in range(COLS):
+            rows = own[col]
+            if rows == []:
+                continue
+            score -= sign * DOUBLED_PAWN_PENALTY * (len(rows) - 1)
+            if (col == 0 or own[col - 1] == []) and (col == COLS - 1 or own[col + 1] == []):
+                score -= sign * ISOLATED_PAWN_PENALTY * len(rows)
+            rival_rows = [rival_row for c in range(max(col - 1, 0), min(col + 2, COLS)) for rival_row in rival[c]]
+            for row in rows:
+                if sign == 1 and all(rival_row > row for rival_row in rival_rows):
+                    score += PASSED_PAWN_BONUS[ROWS - 1 - row]
+                elif sign == -1 and all(rival_row < row for rival_row in rival_rows):
+                    score -= PASSED_PAWN_BONUS[row]
+    return score
+
+def evaluate_board(gs):
+    """
+    Material + piece square + pawn structure evaluation computed from scratch
+    """
     evaluation = 0
     for i in range(ROWS):
         for j in range(COLS):
@@ -212,22 +1035,66 @@ def evaluation(gs):
             if gs.board[i][j][0] == 'b':
                 evaluation -= pst[gs.board[i][j][1]][(7-i)*8 + j]
 
-    return evaluation
+    return evaluation + pawn_structure(gs)
 
-# def move_generation_test(g, depth):
-#     """
-#     To test the number of total valid moves
-#     """
-#     if depth == 0:
-#         return 1
-#     moves = g.get_valid_moves()
-#     positions = 0
-#     for move in moves:
-#         g.make_move(move)
-#         positions += move_generation_test(g, depth-1)
-#         g.undo_move()
-#     return positions
-
-# g = ChessEngine.GameState()
-# print(move_generation_test(g, 3))
+def benchmark_parallel(fen=ChessEngine.START_FEN, workers=WORKERS, depth=DEPTH):
+    """
+    Time to reach depth with find_move and with find_move_parallel from an empty
+    table, and with find_move_parallel again on the table the first one left
+    """
+    global USE_BOOK
+    use_book = USE_BOOK
+    USE_BOOK = False
+    results = {}
+    for name, search in (('single', find_move), ('parallel', find_move_parallel),
+                         ('parallel_again', find_move_parallel)):
+        gs = new_game_state()
+        gs.load_fen(fen)
+        if name != 'parallel_again':
+            tt.clear()
+        start = time.perf_counter()
+        if search is find_move:
+            move = search(gs, gs.get_valid_moves(), depth)
+        else:
+            move = search(gs, gs.get_valid_moves(), workers, depth)
+            # the table comes back from the workers the same size it went out
+            assert len(tt.table) == 2 * tt.size, f"table of {len(tt.table)} words for {tt.size} entries"
+        results[name] = {'seconds': time.perf_counter() - start, 'nodes': nodes,
+                         'depth': completed_depth, 'move': move.get_notation()}
+    USE_BOOK = use_book
+    results['speedup'] = results['single']['seconds'] / results['parallel']['seconds']
+    return results
+
+def benchmark_pruning(fen=ChessEngine.START_FEN, time_limit=5):
+    """
+    Depth reached and nodes searched in the same time with null move pruning and
+    late move reductions switched on and off
+    """
+    global USE_BOOK, USE_NULL_MOVE, USE_LMR
+    settings = (USE_BOOK, USE_NULL_MOVE, USE_LMR)
+    USE_BOOK = False
+    results = {}
+    for USE_NULL_MOVE, USE_LMR in ((False, False), (True, False), (False, True), (True, True)):
+        gs = new_game_state()
+        gs.load_fen(fen)
+        tt.clear()
+        move = find_move(gs, gs.get_valid_moves(), MAX_PLY, time_limit)
+        name = f"null_move={'on' if USE_NULL_MOVE else 'off'} lmr={'on' if USE_LMR else 'off'}"
+        results[name] = {'depth': completed_depth, 'nodes': nodes, 'score': best_score,
+                         'move': move.get_notation()}
+    USE_BOOK, USE_NULL_MOVE, USE_LMR = settings
+    return results
 
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare single process and Lazy SMP search speed')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--depth', type=int, default=DEPTH)
+    parser.add_argument('--fen', default=ChessEngine.START_FEN)
+    parser.add_argument('--pruning', type=float, metavar='SECONDS',
+                        help='compare the depth reached in SECONDS with and without null move pruning and LMR')
+    args = parser.parse_args()
+    if args.pruning:
+        print(json.dumps(benchmark_pruning(args.fen, args.pruning), indent=2))
+    else:
+        print(json.dumps(benchmark_parallel(args.fen, args.workers, args.depth), indent=2))
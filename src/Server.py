@@ -0,0 +1,404 @@
+"""
+Headless game server: hosts many human vs engine games at once over TCP. Every
+request and reply is one JSON object on one line, e.g.
+
+    {"op": "new", "engine": "b", "budget": 300}
+    {"op": "move", "session": "3f9c...", "move": "e2e4"}
+    {"op": "undo", "session": "3f9c...", "plies": 2}
+    {"op": "state", "session": "3f9c..."}
+    {"op": "go", "session": "3f9c..."}
+    {"op": "close", "session": "3f9c..."}
+    {"op": "stats"}
+
+An "id" given with a request is sent back with its reply. Engine moves are
+searched in a bounded pool of worker processes, so a search never holds up the
+other sessions. Every session has its own clock: a budget of seconds, plus an
+increment after every engine move. Requests on a connection are answered in
+order and the next line is only read once the reply has been written, while
+searches beyond the pool's queue wait for a free slot, so clients that send
+faster than the engine can answer are slowed down instead of piling up work.
+Sessions idle for too long, or the least recently used ones when the server
+is full, are closed.
+
+    python src/Server.py --port 8765 --workers 2
+"""
+import argparse
+import asyncio
+import collections
+import json
+import secrets
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import ChessEngine as ChessEngine
+import Searcher as Searcher
+
+HOST = '127.0.0.1'
+PORT = 8765
+WORKERS = 2
+# searches waiting for a worker, per worker, before requests have to wait
+QUEUE_PER_WORKER = 2
+MAX_SESSIONS = 1000
+# seconds without a request after which a session is closed
+SESSION_TIMEOUT = 1800
+EVICT_INTERVAL = 30
+# engine clock of a new session in seconds, and the seconds added after every engine move
+BUDGET = 300
+INCREMENT = 2
+# share of the remaining budget given to a move, and the least time a search gets
+MOVES_TO_GO = 30
+MIN_SEARCH_TIME = 0.05
+# longest request line in bytes
+MAX_LINE = 1 << 16
+# latencies kept per kind of request for the percentiles
+LATENCY_SAMPLES = 1000
+
+class RequestError(Exception):
+    """
+    A request that cannot be carried out, its message is sent back to the client
+    """
+
+def search(gs, time_limit):
+    """
+    Runs in a pool process: the engine move for the position and the numbers of its search
+    """
+    start = time.perf_counter()
+    move = Searcher.find_move(gs, gs.get_valid_moves(), Searcher.MAX_PLY, time_limit)
+    return move.get_notation(), Searcher.best_score, Searcher.completed_depth, Searcher.nodes, \
+        time.perf_counter() - start
+
+def game_status(gs):
+    """
+    'ongoing', or how the game has ended
+    """
+    if gs.get_valid_moves() == []:
+        return 'checkmate' if gs.checkmate else 'stalemate'
+    if gs.fifty_move_draw:
+        return 'fifty_moves'
+    if gs.three_move_draw:
+        return 'repetition'
+    return 'ongoing'
+
+class Session():
+    """
+    One game: its position, which side the engine plays and the engine's clock
+    """
+    def __init__(self, session_id, fen, engine_color, budget, increment):
+        self.id = session_id
+        self.gs = Searcher.new_game_state()
+        self.gs.load_fen(fen)
+        self.engine_color = engine_color
+        self.budget = budget
+        self.increment = increment
+        self.busy = False       # an engine search is running for the session
+        self.last_used = time.monotonic()
+
+    def engine_to_move(self):
+        return self.engine_color == ('w' if self.gs.white_to_move else 'b')
+
+    def time_limit(self):
+        """
+        Seconds for the next engine move, as UCI.go shares out a clock
+        """
+        return max(min(self.budget / MOVES_TO_GO + self.increment, self.budget / 2), MIN_SEARCH_TIME)
+
+    def state(self):
+        gs = self.gs
+        return {
+            'session': self.id,
+            'fen': gs.get_fen(),
+            'moves': [move.get_notation() for move in gs.move_log],
+            'status': game_status(gs),
+            'budget': round(self.budget, 3),
+        }
+
+class LatencyMetrics():
+    """
+    Count, mean and percentiles of the time taken by every kind of request, the
+    percentiles over the most recent LATENCY_SAMPLES of them
+    """
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.totals = collections.Counter()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_SAMPLES))
+
+    def record(self, kind, seconds):
+        self.counts[kind] += 1
+        self.totals[kind] += seconds
+        self.samples[kind].append(seconds)
+
+    def summary(self):
+        summary = {}
+        for kind, samples in self.samples.items():
+            ordered = sorted(samples)
+            summary[kind] = {
+                'count': self.counts[kind],
+                'mean_ms': round(self.totals[kind] / self.counts[kind] * 1000, 2),
+                'p50_ms': round(ordered[len(ordered) // 2] * 1000, 2),
+                'p95_ms': round(ordered[int(len(ordered) * 0.95)] * 1000, 2),
+                'p99_ms': round(ordered[int(len(ordered) * 0.99)] * 1000, 2),
+                'max_ms': round(ordered[-1] * 1000, 2),
+            }
+        return summary
+
+class GameServer():
+    """
+    The sessions, the worker pool and the connections
+    """
+    def __init__(self, workers=WORKERS, max_sessions=MAX_SESSIONS, session_timeout=SESSION_TIMEOUT,
+                 budget=BUDGET, increment=INCREMENT):
+        self.pool = ProcessPoolExecutor(workers)
+        # a search holds a slot from when it is queued until its result is back
+        self.search_slots = asyncio.Semaphore(workers * QUEUE_PER_WORKER)
+        self.sessions = collections.OrderedDict()      # least recently used first
+        self.max_sessions = max_sessions
+        self.session_timeout = session_timeout
+        self.budget = budget
+        self.increment = increment
+        self.metrics = LatencyMetrics()
+        self.connections = 0
+        self.searches_waiting = 0
+        self.searches_running = 0
+        self.evicted = 0
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_LINE)
+        evictor = asyncio.create_task(self.evict_loop())
+        print(f"serving on {', '.join(str(sock.getsockname()) for sock in server.sockets)}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+            self.pool.shutdown(cancel_futures=True)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answers the requests of one connection in order
+        """
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # the line is longer than the stream limit, the rest of it cannot be read
+                    writer.write(self.encode({'error': f"request longer than {MAX_LINE} bytes"}))
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(self.encode(await self.handle_line(line)))
+                # waits while the client is not reading its replies
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def encode(self, reply):
+        return (json.dumps(reply) + '\n').encode()
+
+    async def handle_line(self, line):
+        """
+        The reply to one request line, errors included
+        """
+        start = time.perf_counter()
+        kind = 'invalid'
+        request = {}
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                raise RequestError('request is not JSON')
+            if not isinstance(request, dict):
+                raise RequestError('request is not a JSON object')
+            kind = str(request.get('op'))
+            handler = self.handlers.get(kind)
+            if handler is None:
+                kind = 'invalid'
+                raise RequestError(f"unknown op {request.get('op')}")
+            reply = await handler(self, request)
+        except RequestError as error:
+            reply = {'error': str(error)}
+        if 'id' in request:
+            reply['id'] = request['id']
+        self.metrics.record(kind, time.perf_counter() - start)
+        return reply
+
+    def session(self, request):
+        """
+        The session the request is about, marked as used
+        """
+        session = self.sessions.get(request.get('session'))
+        if session is None:
+            raise RequestError(f"no session {request.get('session')}")
+        session.last_used = time.monotonic()
+        self.sessions.move_to_end(session.id)
+        return session
+
+    def idle_session(self, request):
+        session = self.session(request)
+        if session.busy:
+            raise RequestError('the engine is still thinking')
+        return session
+
+    async def new_game(self, request):
+        if len(self.sessions) >= self.max_sessions and not self.evict_least_recent():
+            raise RequestError('too many sessions')
+        engine_color = request.get('engine', 'b')
+        if engine_color not in ('w', 'b', None):
+            raise RequestError('engine must be "w", "b" or null')
+        try:
+            budget = float(request.get('budget', self.budget))
+            increment = float(request.get('increment', self.increment))
+        except (TypeError, ValueError):
+            raise RequestError('budget and increment must be numbers')
+        session_id = secrets.token_hex(8)
+        try:
+            session = Session(session_id, request.get('fen', ChessEngine.START_FEN), engine_color,
+                              budget, increment)
+        except (ValueError, IndexError, KeyError, AttributeError):
+            raise RequestError('invalid FEN')
+        self.sessions[session_id] = session
+        return await self.engine_reply(session)
+
+    async def make_move(self, request):
+        session = self.idle_session(request)
+        if game_status(session.gs) != 'ongoing':
+            raise RequestError('the game is over')
+        move = session.gs.parse_move(str(request.get('move')))
+        if move is None:
+            raise RequestError(f"illegal move {request.get('move')}")
+        session.gs.make_move(move)
+        return await self.engine_reply(session)
+
+    async def undo(self, request):
+        session = self.idle_session(request)
+        plies = request.get('plies', 1)
+        if not isinstance(plies, int) or not 0 < plies <= len(session.gs.move_log):
+            raise RequestError(f"cannot take back {plies} moves")
+        for _ in range(plies):
+            session.gs.undo_move()
+        return session.state()
+
+    async def state(self, request):
+        return self.session(request).state()
+
+    async def go(self, request):
+        """
+        The engine moves for the side to move, whichever side it plays
+        """
+        session = self.idle_session(request)
+        if game_status(session.gs) != 'ongoing':
+            raise RequestError('the game is over')
+        return await self.engine_move(session)
+
+    async def close(self, request):
+        session = self.idle_session(request)
+        del self.sessions[session.id]
+        return {'session': session.id, 'closed': True}
+
+    async def stats(self, request):
+        return {
+            'sessions': len(self.sessions),
+            'connections': self.connections,
+            'searches_running': self.searches_running,
+            'searches_waiting': self.searches_waiting,
+            'evicted': self.evicted,
+            'latency': self.metrics.summary(),
+        }
+
+    handlers = {'new': new_game, 'move': make_move, 'undo': undo, 'state': state, 'go': go,
+                'close': close, 'stats': stats}
+
+    async def engine_reply(self, session):
+        """
+        The session state, after the engine has moved if it is its turn
+        """
+        if session.engine_to_move() and game_status(session.gs) == 'ongoing':
+            return await self.engine_move(session)
+        return session.state()
+
+    async def engine_move(self, session):
+        """
+        Searches the position in the pool within the session's clock and plays the move
+        """
+        session.busy = True
+        try:
+            self.searches_waiting += 1
+            try:
+                await self.search_slots.acquire()
+            finally:
+                self.searches_waiting -= 1
+            self.searches_running += 1
+            try:
+                loop = asyncio.get_running_loop()
+                notation, score, depth, nodes, seconds = await loop.run_in_executor(
+                    self.pool, search, session.gs, session.time_limit())
+            finally:
+                self.searches_running -= 1
+                self.search_slots.release()
+            self.metrics.record('search', seconds)
+            session.budget = max(session.budget - seconds, 0) + session.increment
+            session.gs.make_move(session.gs.parse_move(notation))
+        finally:
+            session.busy = False
+            session.last_used = time.monotonic()
+        reply = session.state()
+        reply['engine'] = {'move': notation, 'score': score, 'depth': depth, 'nodes': nodes,
+                           'seconds': round(seconds, 3)}
+        return reply
+
+    def evict_least_recent(self):
+        """
+        Closes the least recently used session without a running search, returns
+        False when every session is searching
+        """
+        for session_id, session in self.sessions.items():
+            if not session.busy:
+                del self.sessions[session_id]
+                self.evicted += 1
+                return True
+        return False
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.session_timeout
+        for session_id in [session_id for session_id, session in self.sessions.items()
+                           if session.last_used < deadline and not session.busy]:
+            del self.sessions[session_id]
+            self.evicted += 1
+
+    async def evict_loop(self):
+        while True:
+            await asyncio.sleep(EVICT_INTERVAL)
+            self.evict_idle()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve human vs engine games over TCP as JSON lines')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='engine search processes')
+    parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS)
+    parser.add_argument('--session-timeout', type=float, default=SESSION_TIMEOUT,
+                        help='seconds without a request before a session is closed')
+    parser.add_argument('--budget', type=float, default=BUDGET, help='engine clock of a session in seconds')
+    parser.add_argument('--increment', type=float, default=INCREMENT,
+                        help='seconds added to the engine clock after every engine move')
+    args = parser.parse_args(argv)
+
+    async def run():
+        server = GameServer(args.workers, args.max_sessions, args.session_timeout, args.budget, args.increment)
+        await server.serve(args.host, args.port)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
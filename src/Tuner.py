@@ -0,0 +1,280 @@
+"""
+Texel tuning of the piece values and piece square tables.
+
+Reads a file of labelled positions, one per line: a FEN followed by the game
+result as 1-0, 0-1, 1/2-1/2 or [1.0], [0.5], [0.0], as in the usual EPD
+datasets. Every position is resolved with a quiescence search and the quiet
+position at the end of its principal line is packed into a cache on disk, so
+the positions are read and searched once and never held in memory together.
+The evaluation is linear in the parameters, so the fit is gradient descent
+(Adam) on the logistic loss between the result and sigmoid(scale * eval),
+computed a chunk at a time with NumPy. The result is written as a parameter
+file that Searcher loads at startup from Searcher.PARAMETERS_PATH.
+
+    python src/Tuner.py positions.epd --epochs 50
+    python src/Tuner.py positions.epd --cache /tmp/positions --output tuned.json
+"""
+import argparse
+import json
+import math
+import os
+import re
+import sys
+import time
+import numpy as np
+import ChessEngine as ChessEngine
+import Searcher as Searcher
+import BatchEvaluation as BatchEvaluation
+
+PIECE_TYPES = ('p', 'N', 'B', 'R', 'Q', 'K')
+RESULTS = {'1-0': 1.0, '0-1': 0.0, '1/2-1/2': 0.5, '1.0': 1.0, '0.0': 0.0, '0.5': 0.5}
+RESULT_PATTERN = re.compile(r'(1-0|0-1|1/2-1/2|\[(1\.0|0\.0|0\.5)\])')
+# positions read, resolved and written per batch, and scored per gradient step
+CHUNK = 16384
+# plies of captures followed to find the quiet position
+QUIESCENCE_DEPTH = 8
+# the king value cancels out of every position, so it is left as it is
+FIXED_PIECES = ('K',)
+
+def parse_line(line):
+    """
+    (FEN, result for white) of a dataset line, None for lines without both
+    """
+    match = RESULT_PATTERN.search(line)
+    if match is None:
+        return None
+    fields = line[:match.start()].replace(';', ' ').split()
+    if len(fields) < 2:
+        return None
+    # EPD lines have no move counters and may carry opcodes such as c9 after the board
+    fen = ' '.join(fields[:4])
+    return fen, RESULTS[match.group(2) or match.group(1)]
+
+def quiet_line(gs, alpha, beta, turn_multiplier, depth=QUIESCENCE_DEPTH):
+    """
+    Quiescence search that also returns its principal line of captures
+    """
+    stand_pat = Searcher.evaluation(gs) * turn_multiplier
+    if stand_pat >= beta or depth == 0:
+        return stand_pat, []
+    if alpha < stand_pat:
+        alpha = stand_pat
+    line = []
+    captures = gs.get_capture_moves()
+    Searcher.order_moves(captures)
+    for i in range(len(captures)):
+        move = Searcher.pick_move(captures, i)
+        gs.make_move(move)
+        score, continuation = quiet_line(gs, -beta, -alpha, -turn_multiplier, depth - 1)
+        gs.undo_move()
+        score = -score
+        if score >= beta:
+            return beta, []
+        if score > alpha:
+            alpha = score
+            line = [move] + continuation
+    return alpha, line
+
+def resolve(gs):
+    """
+    Plays the captures of the quiescence line, leaving a quiet position
+    """
+    score, line = quiet_line(gs, -Searcher.CHECKMATE, Searcher.CHECKMATE, 1 if gs.white_to_move else -1)
+    for move in line:
+        gs.make_move(move)
+
+def build_cache(path, cache, resolve_positions=True):
+    """
+    Streams the dataset into cache.boards, the packed quiet positions, and
+    cache.results, the results as float32. Returns the number of positions.
+    """
+    count = 0
+    skipped = 0
+    gs = ChessEngine.GameState()
+    with open(path) as dataset, open(cache + '.boards', 'wb') as boards, \
+        open(cache + '.results', 'wb') as results:
+        packed = bytearray()
+        batch = []
+        for line in dataset:
+            parsed = parse_line(line)
+            if parsed is None:
+                skipped += 1 if line.strip() else 0
+                continue
+            fen, result = parsed
+            try:
+                gs.load_fen(fen)
+            except (ValueError, IndexError):
+                skipped += 1
+                continue
+            if resolve_positions:
+                resolve(gs)
+            packed += bytes(BatchEvaluation.PIECE_CODES[square] for row in gs.board for square in row)
+            batch.append(result)
+            if len(batch) == CHUNK:
+                count += write_batch(packed, batch, boards, results)
+                packed = bytearray()
+                batch = []
+                print(f"resolved {count} positions", file=sys.stderr)
+        count += write_batch(packed, batch, boards, results)
+    if skipped:
+        print(f"skipped {skipped} lines without a position and result", file=sys.stderr)
+    return count
+
+def write_batch(packed, batch, boards, results):
+    boards.write(packed)
+    np.array(batch, dtype=np.float32).tofile(results)
+    return len(batch)
+
+def open_cache(cache):
+    """
+    The cached boards and results, memory-mapped
+    """
+    results = np.memmap(cache + '.results', dtype=np.float32, mode='r')
+    boards = np.memmap(cache + '.boards', dtype=np.int8, mode='r', shape=(len(results), 64))
+    return boards, results
+
+def initial_parameters():
+    """
+    Searcher's piece values and piece square tables without the piece values in
+    them, as a vector: the 6 piece values, then a table of 64 per piece type
+    """
+    values = [Searcher.piece[k] for k in PIECE_TYPES]
+    for k in PIECE_TYPES:
+        values += [value - Searcher.piece[k] for value in Searcher.pst[k]]
+    return np.array(values, dtype=np.float64)
+
+def value_table(parameters):
+    """
+    The (13, 64) table of BatchEvaluation for a parameter vector
+    """
+    table = np.zeros((len(BatchEvaluation.PIECES), 64), dtype=np.float64)
+    mirror = np.arange(64).reshape(8, 8)[::-1].ravel()
+    for t, k in enumerate(PIECE_TYPES):
+        values = parameters[t] + parameters[6 + 64 * t:6 + 64 * (t + 1)]
+        table[BatchEvaluation.PIECE_CODES['w' + k]] = values
+        table[BatchEvaluation.PIECE_CODES['b' + k]] = -values[mirror]
+    return table
+
+def table_gradient(square_gradient):
+    """
+    Gradient of the parameter vector from the gradient of the (13, 64) table
+    """
+    gradient = np.zeros(6 + 64 * 6)
+    mirror = np.arange(64).reshape(8, 8)[::-1].ravel()
+    for t, k in enumerate(PIECE_TYPES):
+        tables = square_gradient[BatchEvaluation.PIECE_CODES['w' + k]] - \
+            square_gradient[BatchEvaluation.PIECE_CODES['b' + k]][mirror]
+        gradient[6 + 64 * t:6 + 64 * (t + 1)] = tables
+        gradient[t] = tables.sum()
+    return gradient
+
+def evaluate(boards, table):
+    """
+    Scores of the boards and their (square, piece) indices into the table. The
+    pawn structure terms are not tuned and only added to the scores.
+    """
+    offsets = np.arange(64) * len(BatchEvaluation.PIECES)
+    indices = boards.astype(np.intp) + offsets
+    scores = np.take(table.T.ravel(), indices).sum(axis=1) + BatchEvaluation.pawn_structure(boards)
+    return scores, indices
+
+def loss(boards, results, parameters, scale):
+    """
+    Mean logistic loss of the parameters over the cached positions
+    """
+    table = value_table(parameters)
+    total = 0.0
+    for start in range(0, len(results), CHUNK):
+        scores, indices = evaluate(boards[start:start + CHUNK], table)
+        expected = 1 / (1 + np.exp(-scale * scores))
+        expected = np.clip(expected, 1e-12, 1 - 1e-12)
+        result = results[start:start + CHUNK]
+        total -= np.sum(result * np.log(expected) + (1 - result) * np.log(1 - expected))
+    return total / len(results)
+
+def fit_scale(boards, results, parameters):
+    """
+    The scale of the sigmoid that fits the results best with the starting parameters
+    """
+    best = None
+    for k in np.arange(0.2, 3.0, 0.1):
+        scale = k * math.log(10) / 400
+        current = loss(boards, results, parameters, scale)
+        if best is None or current < best[0]:
+            best = (current, scale)
+    return best[1]
+
+def tune(boards, results, parameters, scale, epochs, learning_rate=1.0):
+    """
+    Adam over chunks of positions. The gradient of the loss for a position is
+    (expected - result) * scale times the count of every piece on every square,
+    which bincount sums over the chunk without building a feature matrix.
+    """
+    fixed = [PIECE_TYPES.index(k) for k in FIXED_PIECES]
+    first_moment = np.zeros_like(parameters)
+    second_moment = np.zeros_like(parameters)
+    step = 0
+    size = len(BatchEvaluation.PIECES) * 64
+    for epoch in range(epochs):
+        start_time = time.perf_counter()
+        for start in range(0, len(results), CHUNK):
+            chunk = boards[start:start + CHUNK]
+            scores, indices = evaluate(chunk, value_table(parameters))
+            expected = 1 / (1 + np.exp(-scale * scores))
+            errors = (expected - results[start:start + CHUNK]) * scale / len(chunk)
+            square_gradient = np.bincount(indices.ravel(), weights=np.repeat(errors, 64), minlength=size)
+            gradient = table_gradient(square_gradient.reshape(64, len(BatchEvaluation.PIECES)).T)
+            gradient[fixed] = 0
+            step += 1
+            first_moment = 0.9 * first_moment + 0.1 * gradient
+            second_moment = 0.999 * second_moment + 0.001 * gradient * gradient
+            parameters -= learning_rate * (first_moment / (1 - 0.9 ** step)) / \
+                (np.sqrt(second_moment / (1 - 0.999 ** step)) + 1e-8)
+        print(f"epoch {epoch + 1}: loss {loss(boards, results, parameters, scale):.6f} "
+              f"in {time.perf_counter() - start_time:.1f}s", file=sys.stderr)
+    return parameters
+
+def write_parameters(path, parameters):
+    """
+    Writes the parameter file Searcher.load_parameters reads
+    """
+    rounded = [int(round(value)) for value in parameters]
+    output = {
+        'piece': {k: rounded[t] for t, k in enumerate(PIECE_TYPES)},
+        'pst': {k: rounded[6 + 64 * t:6 + 64 * (t + 1)] for t, k in enumerate(PIECE_TYPES)},
+    }
+    with open(path, 'w') as parameters_file:
+        json.dump(output, parameters_file, indent=1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fit piece values and piece square tables to game results')
+    parser.add_argument('dataset', help='file of FEN + result lines')
+    parser.add_argument('--cache', help='path of the resolved position cache without extension '
+                        '(default: next to the dataset), reused when it exists')
+    parser.add_argument('--rebuild', action='store_true', help='resolve the positions again')
+    parser.add_argument('--no-resolve', action='store_true', help='use the positions as they are')
+    parser.add_argument('--epochs', type=int, default=20)
+    parser.add_argument('--learning-rate', type=float, default=1.0, help='step size in centipawns')
+    parser.add_argument('--scale', type=float, help='sigmoid scale, fitted to the data when not given')
+    parser.add_argument('--output', default=Searcher.PARAMETERS_PATH)
+    args = parser.parse_args(argv)
+
+    cache = args.cache or os.path.splitext(args.dataset)[0]
+    if args.rebuild or not os.path.exists(cache + '.results'):
+        count = build_cache(args.dataset, cache, not args.no_resolve)
+        print(f"cached {count} positions in {cache}.boards", file=sys.stderr)
+    boards, results = open_cache(cache)
+    if len(results) == 0:
+        print('no positions to tune on', file=sys.stderr)
+        return 1
+
+    parameters = initial_parameters()
+    scale = args.scale or fit_scale(boards, results, parameters)
+    print(f"scale {scale:.6f}, starting loss {loss(boards, results, parameters, scale):.6f}", file=sys.stderr)
+    parameters = tune(boards, results, parameters, scale, args.epochs, args.learning_rate)
+    write_parameters(args.output, parameters)
+    print(f"wrote {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Headless UCI front-end: reads commands on stdin and answers on stdout, so the
+engine can be run by tournament managers and on servers without a display.
+
+    python src/UCI.py
+"""
+import sys
+import threading
+import ChessEngine as ChessEngine
+import Searcher as Searcher
+
+NAME = 'chessbot'
+AUTHOR = 'kireetii'
+# depth searched when go gives no depth, e.g. for go movetime or go infinite
+MAX_DEPTH = 64
+# fraction of the remaining clock given to a move when the number of moves is unknown
+MOVES_TO_GO = 30
+# kept back from every time limit for the reply to reach the GUI
+MOVE_OVERHEAD = 0.05
+
+class UCIEngine():
+    """
+    Protocol state: the game state and how it was set up, and the running search
+    """
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.gs = Searcher.new_game_state()
+        self.fen = ChessEngine.START_FEN
+        self.moves = []     # moves applied to the position given by fen
+        self.search_thread = None
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def handle(self, line):
+        """
+        Handles one command line, returns False when the engine should quit
+        """
+        tokens = line.split()
+        if tokens == []:
+            return True
+        command = tokens[0]
+        if command == 'uci':
+            self.send(f"id name {NAME}")
+            self.send(f"id author {AUTHOR}")
+            self.send(f"option name Hash type spin default {Searcher.HASH_SIZE_MB} min 1 max 4096")
+            self.send(f"option name OwnBook type check default {'true' if Searcher.USE_BOOK else 'false'}")
+            self.send('uciok')
+        elif command == 'isready':
+            self.send('readyok')
+        elif command == 'setoption':
+            self.wait()
+            self.set_option(tokens[1:])
+        elif command == 'ucinewgame':
+            self.wait()
+            Searcher.tt.clear()
+        elif command == 'position':
+            self.wait()
+            self.position(tokens[1:])
+        elif command == 'go':
+            self.wait()
+            self.go(tokens[1:])
+        elif command == 'stop':
+            self.stop()
+        elif command == 'quit':
+            self.stop()
+            return False
+        return True
+
+    def wait(self):
+        """
+        Waits for a running search to finish
+        """
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+
+    def stop(self):
+        """
+        Stops the running search, repeating the request in case the search had
+        not started yet when it was first made
+        """
+        while self.search_thread is not None and self.search_thread.is_alive():
+            Searcher.stop()
+            self.search_thread.join(0.01)
+        self.search_thread = None
+
+    def set_option(self, tokens):
+        if 'name' not in tokens or 'value' not in tokens:
+            return
+        name = ' '.join(tokens[tokens.index('name') + 1:tokens.index('value')]).lower()
+        value = ' '.join(tokens[tokens.index('value') + 1:])
+        if name == 'hash':
+            Searcher.set_hash_size(int(value))
+        elif name == 'ownbook':
+            Searcher.set_book(Searcher.Book.TEST_BOOK if value.lower() == 'true' else None)
+
+    def position(self, tokens):
+        """
+        Sets up the position, only making or undoing the moves that differ from
+        the position already on the board
+        """
+        if 'moves' in tokens:
+            moves = tokens[tokens.index('moves') + 1:]
+            tokens = tokens[:tokens.index('moves')]
+        else:
+            moves = []
+        if tokens[0] == 'startpos':
+            fen = ChessEngine.START_FEN
+        elif tokens[0] == 'fen':
+            fen = ' '.join(tokens[1:])
+        else:
+            return
+        if fen != self.fen:
+            self.gs.load_fen(fen)
+            self.fen = fen
+            self.moves = []
+        common = 0
+        while common < min(len(moves), len(self.moves)) and moves[common] == self.moves[common]:
+            common += 1
+        while len(self.moves) > common:
+            self.gs.undo_move()
+            self.moves.pop()
+        for notation in moves[common:]:
+            move = self.gs.parse_move(notation)
+            if move is None:
+                self.send(f"info string illegal move {notation}")
+                return
+            self.gs.make_move(move)
+            self.moves.append(notation)
+
+    def go(self, tokens):
+        """
+        Starts a search in the background, bestmove is sent when it finishes
+        """
+        limits = {}
+        for i, token in enumerate(tokens[:-1]):
+            if token in ('depth', 'nodes', 'movetime', 'wtime', 'btime', 'winc', 'binc', 'movestogo'):
+                limits[token] = int(tokens[i + 1])
+        depth = limits.get('depth', MAX_DEPTH if len(limits) > 0 or 'infinite' in tokens else Searcher.DEPTH)
+        time_limit = None
+        if 'movetime' in limits:
+            time_limit = limits['movetime'] / 1000
+        elif ('wtime' if self.gs.white_to_move else 'btime') in limits:
+            remaining = limits['wtime' if self.gs.white_to_move else 'btime'] / 1000
+            increment = limits.get('winc' if self.gs.white_to_move else 'binc', 0) / 1000
+            time_limit = min(remaining / limits.get('movestogo', MOVES_TO_GO) + increment, remaining / 2)
+        if time_limit is not None:
+            time_limit = max(time_limit - MOVE_OVERHEAD, 0.01)
+        self.search_thread = threading.Thread(target=self.search,
+                                              args=(depth, time_limit, limits.get('nodes')))
+        self.search_thread.start()
+
+    def search(self, depth, time_limit, node_limit):
+        valid_moves = self.gs.get_valid_moves()
+        if valid_moves == []:
+            self.send('bestmove 0000')
+            return
+        move = Searcher.find_move(self.gs, valid_moves, depth, time_limit, node_limit, self.info)
+        self.send(f"info string first move cutoff rate {Searcher.first_move_cutoff_rate():.3f}")
+        self.send(f"bestmove {move.get_notation()}")
+
+    def info(self, depth, score, nodes, seconds):
+        """
+        Reports a completed iteration
+        """
+        if abs(score) > Searcher.MATE_BOUND:
+            plies = Searcher.CHECKMATE - abs(score)
+            score_text = f"mate {(plies + 1) // 2 if score > 0 else -((plies + 1) // 2)}"
+        else:
+            score_text = f"cp {score}"
+        pv = ' '.join(move.get_notation() for move in Searcher.principal_variation(self.gs, depth))
+        self.send(f"info depth {depth} seldepth {Searcher.selective_depth} score {score_text} nodes {nodes} "
+                  f"nps {int(nodes / seconds) if seconds > 0 else 0} time {int(seconds * 1000)} pv {pv}")
+
+def main():
+    engine = UCIEngine()
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+    engine.wait()
+
+if __name__ == "__main__":
+    main()